@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Parser for FlexSPI NOR Configuration Blocks.
+
+The whole 512-byte block is described by LAYOUT and decoded with a single
+struct. Can be imported (FCB(data)) or run on one or more fcb binaries.
+"""
+
+import collections
+import struct
+import sys
+
+FCB_TAG = 0x42464346
+FCB_SIZE = 0x200
+
+# one entry of deviceModeSeq, configCmdSeqs and lutCustomSeq
+Seq = collections.namedtuple('Seq', ['seqNum', 'seqIdx'])
+
+# one 32-bit LUT entry, which holds two instructions
+LutEntry = collections.namedtuple('LutEntry', ['opcode0', 'pads0', 'operand0', 'opcode1', 'pads1', 'operand1'])
+
+# (name, format of one element, element count), unnamed entries are reserved
+LAYOUT = [
+    ('tag',                     'I',    1),
+    ('version',                 'I',    1),
+    (None,                      '4x',   1),
+    ('readSampleClkSrc',        'B',    1),
+    ('csHoldTime',              'B',    1),
+    ('csSetupTime',             'B',    1),
+    ('columnAddressWidth',      'B',    1),
+    ('deviceModeCfgEnable',     'B',    1),
+    ('deviceModeType',          'B',    1),
+    ('waitTimeCfgCommands',     'H',    1),
+    ('deviceModeSeq',           'BB2x', 1),
+    ('deviceModeArg',           'I',    1),
+    ('configCmdEnable',         'B',    1),
+    ('configModeType',          'B',    3),
+    ('configCmdSeqs',           'BB2x', 3),
+    (None,                      '4x',   1),
+    ('configCmdArgs',           'I',    3),
+    (None,                      '4x',   1),
+    ('controllerMiscOption',    'I',    1),
+    ('deviceType',              'B',    1),
+    ('sflashPadType',           'B',    1),
+    ('serialClkFreq',           'B',    1),
+    ('lutCustomSeqEnable',      'B',    1),
+    (None,                      '8x',   1),
+    ('sflashA1Size',            'I',    1),
+    ('sflashA2Size',            'I',    1),
+    ('sflashB1Size',            'I',    1),
+    ('sflashB2Size',            'I',    1),
+    ('csPadSettingOverride',    'I',    1),
+    ('sclkPadSettingOverride',  'I',    1),
+    ('dataPadSettingOverride',  'I',    1),
+    ('dqsPadSettingOverride',   'I',    1),
+    ('timeoutInMs',             'I',    1),
+    ('commandInterval',         'I',    1),
+    ('dataValidTime',           'H',    2),
+    ('busyOffset',              'H',    1),
+    ('busyBitPolarity',         'H',    1),
+    ('lookupTable',             'I',    64),
+    ('lutCustomSeq',            'BB2x', 12),
+    (None,                      '16x',  1),
+    ('pageSize',                'I',    1),
+    ('sectorSize',              'I',    1),
+    ('ipcmdSerialClkFreq',      'B',    1),
+    ('isUniformBlockSize',      'B',    1),
+    ('isDataOrderSwapped',      'B',    1),
+    (None,                      'x',    1),
+    ('serialNorType',           'B',    1),
+    ('needExitNoCmdMode',       'B',    1),
+    ('halfClkForNonReadCmd',    'B',    1),
+    ('needRestoreNoCmdMode',    'B',    1),
+    ('blockSize',               'I',    1),
+    (None,                      '44x',  1),
+]
+
+FCB_STRUCT = struct.Struct('<' + ''.join([fmt * count for _, fmt, count in LAYOUT]))
+assert FCB_STRUCT.size == FCB_SIZE
+
+# fields which hold more than one element
+ARRAY_FIELDS = ['configModeType', 'configCmdSeqs', 'configCmdArgs', 'dataValidTime', 'lookupTable', 'lutCustomSeq']
+
+class FCBError(Exception):
+    """Invalid FlexSPI NOR Configuration Block"""
+
+def decodeLutEntry(entry):
+    return LutEntry(
+        (entry & 0xfc00) >> 10, (entry & 0x300) >> 8, entry & 0xff,
+        (entry & 0xfc000000) >> 26, (entry & 0x3000000) >> 24, (entry & 0xff0000) >> 16)
+
+class FCB:
+    """Decoded FlexSPI NOR Configuration Block, every field in LAYOUT is an attribute"""
+
+    def __init__(self, data):
+        if len(data) < FCB_SIZE:
+            raise FCBError(f'FCB is {len(data)} bytes, expected {FCB_SIZE}')
+
+        values = iter(FCB_STRUCT.unpack_from(data))
+        for name, fmt, count in LAYOUT:
+            if not name:
+                continue
+
+            elements = []
+            for _ in range(count):
+                if fmt == 'BB2x':
+                    elements.append(Seq(next(values), next(values)))
+                else:
+                    elements.append(next(values))
+
+            setattr(self, name, elements if name in ARRAY_FIELDS else elements[0])
+
+        if self.tag != FCB_TAG:
+            raise FCBError(f'Invalid tag {self.tag:08x}')
+
+        # 16 sequences of 4 entries
+        self.lookupTable = [[decodeLutEntry(e) for e in self.lookupTable[i:i + 4]] for i in range(0, 64, 4)]
+
+    def fields(self):
+        """Returns (name, formatted value) of every field, with arrays and LUT sequences split up"""
+
+        fields = []
+        for name, fmt, count in LAYOUT:
+            if not name:
+                continue
+
+            value = getattr(self, name)
+            if name == 'lookupTable':
+                for i, seq in enumerate(value):
+                    for j, entry in enumerate(seq):
+                        fields.append((f'{name}[{i}][{j}]', formatLutEntry(entry)))
+            elif name in ARRAY_FIELDS:
+                for i, element in enumerate(value):
+                    fields.append((f'{name}[{i}]', formatValue(element, fmt)))
+            else:
+                fields.append((name, formatValue(value, fmt)))
+
+        return fields
+
+def formatValue(value, fmt):
+    if fmt == 'BB2x':
+        return f'seqNum: {value.seqNum:02x} seqIdx: {value.seqIdx:02x}'
+    return f'{value:0{struct.calcsize(fmt) * 2}x}'
+
+def formatLutEntry(entry):
+    return 'FLEXSPI_LUT_SEQ({:02x}, {:02x}, {:02x}, {:02x}, {:02x}, {:02x})'.format(*entry)
+
+def load(path):
+    with open(path, 'rb') as f:
+        return FCB(f.read())
+
+def printFCB(fcb):
+    for name, fmt, count in LAYOUT:
+        if not name:
+            continue
+
+        value = getattr(fcb, name)
+        if name == 'lookupTable':
+            print(f'{name}:')
+            for i, seq in enumerate(value):
+                print(f'\t{i}:')
+                for entry in seq:
+                    print('\t\t' + formatLutEntry(entry))
+        elif fmt == 'BB2x':
+            print(f'{name}:')
+            for seq in (value if name in ARRAY_FIELDS else [value]):
+                print(f'\tseqNum: {seq.seqNum:02x}')
+                print(f'\tseqIdx: {seq.seqIdx:02x}')
+        elif name in ARRAY_FIELDS:
+            print(f'{name}: ' + ' '.join([formatValue(v, fmt) for v in value]))
+        else:
+            print(f'{name}: {formatValue(value, fmt)}')
+
+def diff(fcbs):
+    """Returns (name, [value per fcb]) of every field which isn't the same in all fcbs"""
+
+    columns = [fcb.fields() for fcb in fcbs]
+    differences = []
+    for i, (name, _) in enumerate(columns[0]):
+        values = [fields[i][1] for fields in columns]
+        if len(set(values)) > 1:
+            differences.append((name, values))
+
+    return differences
+
+def main(args):
+    if len(args) < 1 or (args[0] == '--diff' and len(args) < 3):
+        print(f'Usage:\npython3 {sys.argv[0]} <fcb.bin> [<fcb.bin> ...]\npython3 {sys.argv[0]} --diff <fcb.bin> <fcb.bin> [<fcb.bin> ...]')
+        sys.exit(1)
+
+    show_diff = args[0] == '--diff'
+    paths = args[1:] if show_diff else args
+
+    fcbs = []
+    failed = False
+    for path in paths:
+        try:
+            fcbs.append((path, load(path)))
+        except (OSError, FCBError) as e:
+            print(f'{path}: {e}')
+            failed = True
+
+    if show_diff:
+        if len(fcbs) > 1:
+            differences = diff([fcb for _, fcb in fcbs])
+            for i, (path, _) in enumerate(fcbs):
+                print(f'[{i}] {path}')
+            for name, values in differences:
+                print(f'{name}:')
+                for i, value in enumerate(values):
+                    print(f'\t[{i}] {value}')
+            print(f'{len(differences)} fields differ')
+    else:
+        for path, fcb in fcbs:
+            if len(paths) > 1:
+                print(f'==> {path} <==')
+            printFCB(fcb)
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Protocol throughput benchmarks against the simulated controller.
+
+Every scenario reports bytes/sec, USB transfers and commands per KiB and
+latency percentiles of its individual operations. Results are compared
+against a stored baseline on what doesn't depend on the host: transfer and
+command counts must not increase, and the modeled throughput (bytes over the
+simulated transfer latency and flash operation time) may only drop within
+the given tolerance. Wall clock numbers are only printed, they vary too much
+between machines to be compared against a baseline from another one.
+"""
+
+import simulator, sdp, flashloader, stadiatool
+import json
+import os
+import statistics
+import sys
+import time
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# default latency per USB transfer in seconds, one high-speed microframe
+LATENCY = 0.000125
+
+# default allowed drop of the modeled throughput against the baseline
+TOLERANCE = 0.01
+
+# fields of every scenario compare() needs in the baseline
+COMPARED_FIELDS = ['transfers_per_kib', 'commands_per_kib', 'modeled_bytes_per_sec', 'latency']
+
+class Benchmark:
+    name = ''
+    size = 0
+    durations = None
+    transfers = 0
+    commands = 0
+    device_seconds = 0
+    elapsed = 0
+
+    def __init__(self, name):
+        self.name = name
+        self.durations = []
+
+    def measure(self, func, *args):
+        start = time.perf_counter()
+        ret = func(*args)
+        self.durations.append(time.perf_counter() - start)
+        return ret
+
+    def result(self):
+        kib = self.size / 1024
+        percentiles = [0, 0, 0]
+        if len(self.durations) > 1:
+            quantiles = statistics.quantiles(self.durations, n=100, method='inclusive')
+            percentiles = [quantiles[49], quantiles[89], quantiles[98]]
+        elif self.durations:
+            percentiles = self.durations * 3
+
+        return {
+            'bytes': self.size,
+            'operations': len(self.durations),
+            'seconds': self.elapsed,
+            'bytes_per_sec': self.size / self.elapsed if self.elapsed else 0,
+            'transfers_per_kib': self.transfers / kib if kib else 0,
+            'commands_per_kib': self.commands / kib if kib else 0,
+            'modeled_bytes_per_sec': self.size / self.device_seconds if self.device_seconds else 0,
+            'p50_ms': percentiles[0] * 1000,
+            'p90_ms': percentiles[1] * 1000,
+            'p99_ms': percentiles[2] * 1000,
+        }
+
+def runScenario(name, controller, func, *args):
+    bench = Benchmark(name)
+    controller.reset_stats()
+    start = time.perf_counter()
+    func(bench, *args)
+    bench.elapsed = time.perf_counter() - start
+    bench.transfers = controller.stats['out'] + controller.stats['in']
+    bench.commands = controller.stats['commands']
+    bench.device_seconds = controller.stats['device_seconds']
+    return bench.result()
+
+def openFlashloader(controller):
+    stadiatool.detachKernelDriver(controller.device)
+    fl = flashloader.Flashloader(controller.device)
+    fl.write_memory(0x2000, simulator.make_fcb())
+    fl.configure_memory(9, 0x2000)
+    fl.flash_size = 0x1000000
+    return fl
+
+def benchSDPWriteFile(bench, _sdp, size):
+    data = os.urandom(size)
+    bench.size = size
+    bench.measure(_sdp.write_file, 0x20200000, data)
+
+def benchWriteMemory(bench, fl, size, chunk):
+    data = os.urandom(size)
+    bench.size = size
+    for pos in range(0, size, chunk):
+        bench.measure(fl.write_memory, 0x60400000 + pos, data[pos:pos+chunk])
+
+def benchEraseRegion(bench, fl, address, size):
+    bench.size = size
+    for command in fl.plan_erase(address, size):
+        bench.measure(fl.flash_erase_region, *command)
+
+def benchReadMemory(bench, fl, size, chunk):
+    bench.size = size
+    for pos in range(0, size, chunk):
+        bench.measure(fl.read_memory, 0x60000000 + pos, chunk)
+
+def benchFlashRead32(bench, fl, words):
+    bench.size = words * 4
+    for i in range(words):
+        bench.measure(stadiatool.flashRead32, fl, i * 4, 4)
+
+def runAll(latency):
+    controller = simulator.SimulatedController(mode='sdp', latency=latency, attach=False)
+    # typical W25Q128JW erase times
+    controller.sector_erase_time = 0.045
+    controller.block_erase_time = 0.150
+
+    results = {}
+    stadiatool.detachKernelDriver(controller.device)
+    results['sdp_write_file'] = runScenario('sdp_write_file', controller, benchSDPWriteFile, sdp.SDP(controller.device), 0x40000)
+
+    controller.reenumerate('flashloader')
+    fl = openFlashloader(controller)
+    results['write_memory'] = runScenario('write_memory', controller, benchWriteMemory, fl, 0x100000, 0x10000)
+    results['flash_erase_region'] = runScenario('flash_erase_region', controller, benchEraseRegion, fl, 0x60040000, 0x100000)
+    results['read_memory'] = runScenario('read_memory', controller, benchReadMemory, fl, 0x100000, stadiatool.dumpChunkSize)
+    results['flash_read32'] = runScenario('flash_read32', controller, benchFlashRead32, fl, 256)
+
+    for result in results.values():
+        result['latency'] = latency
+
+    return results
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regressions against the baseline"""
+
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            regressions.append(f'{name}: not in the baseline, run with --save to regenerate it')
+            continue
+
+        missing = [field for field in COMPARED_FIELDS if field not in base]
+        if missing:
+            regressions.append(f'{name}: baseline has no {", ".join(missing)}, run with --save to regenerate it')
+            continue
+
+        if result['transfers_per_kib'] > base['transfers_per_kib'] * 1.0001:
+            regressions.append(f'{name}: {result["transfers_per_kib"]:.2f} transfers/KiB, baseline {base["transfers_per_kib"]:.2f}')
+        if result['commands_per_kib'] > base['commands_per_kib'] * 1.0001:
+            regressions.append(f'{name}: {result["commands_per_kib"]:.3f} commands/KiB, baseline {base["commands_per_kib"]:.3f}')
+        # the modeled time scales with the latency, only comparable with the same one
+        if result['latency'] == base['latency'] and \
+                result['modeled_bytes_per_sec'] < base['modeled_bytes_per_sec'] * (1 - tolerance):
+            regressions.append(f'{name}: {result["modeled_bytes_per_sec"] / 1024:.1f} modeled KiB/s, ' +
+                f'baseline {base["modeled_bytes_per_sec"] / 1024:.1f} modeled KiB/s')
+
+    return regressions
+
+def printResults(results):
+    print(f'{"scenario":<20} {"KiB/s":>10} {"model KiB/s":>12} {"xfers/KiB":>10} {"cmds/KiB":>9} {"ops":>6} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8}')
+    for name, r in results.items():
+        print(f'{name:<20} {r["bytes_per_sec"] / 1024:>10.1f} {r["modeled_bytes_per_sec"] / 1024:>12.1f} '
+            f'{r["transfers_per_kib"]:>10.2f} {r["commands_per_kib"]:>9.3f} {r["operations"]:>6} '
+            f'{r["p50_ms"]:>8.2f} {r["p90_ms"]:>8.2f} {r["p99_ms"]:>8.2f}')
+
+def main():
+    args = sys.argv[1:]
+    latency = float(args[args.index('--latency') + 1]) if '--latency' in args else LATENCY
+    tolerance = float(args[args.index('--tolerance') + 1]) if '--tolerance' in args else TOLERANCE
+    baseline_file = args[args.index('--baseline') + 1] if '--baseline' in args else BASELINE_FILE
+
+    results = runAll(latency)
+    printResults(results)
+
+    if '--save' in args:
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f'Saved baseline to {baseline_file}')
+        return
+
+    if not os.path.exists(baseline_file):
+        print('No baseline to compare against, run with --save first')
+        return
+
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)
+
+    if any([r.get('latency') not in [None, latency] for r in baseline.values()]):
+        print(f'Modeled throughput is only compared at the latency of the baseline, not {latency}')
+
+    regressions = compare(results, baseline, tolerance)
+    if regressions:
+        print('Regressions against baseline:')
+        for r in regressions:
+            print('    ' + r)
+        sys.exit(1)
+
+    print('No regressions against baseline')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+"""
+Daemon mode, keeps controllers open between commands.
+
+The daemon listens on a Unix socket for jobs (info, flashloader, dump,
+flash_firmware, reset). Every controller gets a worker thread with its own job
+queue, which holds on to the opened device and, while it's in flashloader mode,
+the Flashloader with the detected MCU and flash configuration. Subsequent jobs
+skip the bus scan, HID setup and flash detection.
+
+Requests and responses are single lines of JSON.
+
+Jobs write dump files and read firmware files from the paths in the requests,
+so only the user running the daemon can connect: the socket lives in
+$XDG_RUNTIME_DIR, or in a per-user directory only accessible by that user,
+and clients with another user id are refused.
+"""
+
+import stadiatool
+import station
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+import threading
+
+SOCKET_NAME = 'stadiatool.sock'
+
+JOB_COMMANDS = ['info', 'flashloader', 'dump', 'flash_firmware', 'reset']
+
+class DaemonOutput:
+    """
+    stdout replacement which collects the output of the current worker thread
+    into its job, so it can be sent back to the client.
+    Progress updates using carriage returns are collapsed to their last state.
+    """
+
+    stream = None
+    local = None
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def set_job(self, job):
+        self.local.job = job
+
+    def write(self, text):
+        job = getattr(self.local, 'job', None)
+        if job == None:
+            return self.stream.write(text)
+
+        job.output += text
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+class DaemonJob:
+    command = ''
+    args = None
+    output = ''
+    error = ''
+    done = None
+
+    def __init__(self, command, args):
+        self.command = command
+        self.args = args
+        self.done = threading.Event()
+
+    def response(self):
+        lines = [line.split('\r')[-1] for line in self.output.split('\n')]
+        return {
+            'status': 'failed' if self.error else 'done',
+            'error': self.error,
+            'output': '\n'.join([line for line in lines if line]),
+        }
+
+class DeviceWorker:
+    """Runs the jobs of a single controller, tracked by its port path"""
+
+    path = ''
+    jobs = None
+    thread = None
+
+    # currently opened device and flashloader session
+    dev = None
+    fl = None
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(daemon=True, target=DeviceWorker.run, args=(self,))
+        self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            sys.stdout.set_job(job)
+            try:
+                self.run_job(job)
+            except SystemExit:
+                job.error = 'aborted'
+            except Exception as e:
+                job.error = f'{type(e).__name__}: {e}'
+                # registers might be in an unknown state now
+                if self.fl:
+                    self.fl.flexspi.invalidate()
+            finally:
+                sys.stdout.set_job(None)
+                job.done.set()
+
+    def close(self):
+        self.dev = None
+        self.fl = None
+
+    def get_device(self):
+        """Returns the device at this path, reusing the open one if it didn't re-enumerate"""
+
+        dev = None
+        for d in station.findControllers():
+            if stadiatool.getDevicePath(d) == self.path:
+                dev = d
+                break
+
+        if not dev:
+            self.close()
+            raise RuntimeError(f'no controller at {self.path}')
+
+        if self.dev and (dev.idVendor, dev.idProduct, dev.address) == (self.dev.idVendor, self.dev.idProduct, self.dev.address):
+            return self.dev
+
+        self.close()
+        stadiatool.openDevice(dev)
+        self.dev = dev
+        return dev
+
+    def get_flashloader(self):
+        dev = self.get_device()
+        if (dev.idVendor, dev.idProduct) != station.MODE_FLASHLOADER:
+            raise RuntimeError('controller is not in flashloader mode')
+
+        if not self.fl:
+            self.fl = stadiatool.openFlashloader(dev)
+
+        return self.fl
+
+    def run_job(self, job):
+        args = job.args
+
+        if job.command == 'info':
+            stadiatool.printInfo(self.get_device())
+        elif job.command == 'flashloader':
+            dev = self.get_device()
+            self.close()
+            stadiatool.loadFlashloader(dev, args.get('path'))
+        elif job.command == 'dump':
+            fl = self.get_flashloader()
+            stadiatool.dumpFlash(fl.device, args['start'], args['end'], args['path'], args.get('mode', 'ahb'), fl)
+        elif job.command == 'flash_firmware':
+            fl = self.get_flashloader()
+            stadiatool.flashFirmware(fl.device, args['path'], args.get('delta', False), fl)
+            # the controller resets into the new firmware. until then the session is kept, its
+            # HID reader stays alive and a second one would take the reports of the next job
+            self.close()
+        elif job.command == 'reset':
+            dev = self.get_device()
+            stadiatool.reset(dev, self.fl)
+            self.close()
+
+class Daemon:
+    workers = None
+    lock = None
+
+    def __init__(self):
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def list_controllers(self):
+        controllers = []
+        for dev in station.findControllers():
+            path = stadiatool.getDevicePath(dev)
+            worker = self.workers.get(path)
+            controllers.append({
+                'path': path,
+                'mode': f'{dev.idVendor:04x}:{dev.idProduct:04x}',
+                'open': bool(worker and worker.fl),
+            })
+
+        return controllers
+
+    def find_path(self, path):
+        if path:
+            return path
+
+        # default to the only attached controller
+        devices = station.findControllers()
+        if len(devices) != 1:
+            raise RuntimeError(f'found {len(devices)} controllers, select one with --device')
+
+        return stadiatool.getDevicePath(devices[0])
+
+    def submit(self, command, args, path=None):
+        job = DaemonJob(command, args)
+        path = self.find_path(path)
+        with self.lock:
+            if path not in self.workers:
+                self.workers[path] = DeviceWorker(path)
+            self.workers[path].jobs.put(job)
+
+        job.done.wait()
+        return job.response()
+
+    def handle(self, request):
+        command = request.get('command')
+        if command == 'list':
+            return {'status': 'done', 'controllers': self.list_controllers()}
+
+        if command not in JOB_COMMANDS:
+            return {'status': 'failed', 'error': f'unknown command "{command}"'}
+
+        try:
+            return self.submit(command, request.get('args', {}), request.get('device'))
+        except RuntimeError as e:
+            return {'status': 'failed', 'error': str(e)}
+
+def getSocketPath():
+    """Returns the default socket path of the current user"""
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, SOCKET_NAME)
+
+    return os.path.join(tempfile.gettempdir(), f'stadiatool-{os.getuid()}', SOCKET_NAME)
+
+def makeSocketDir(path):
+    """Creates the directory of the default socket, which only the current user may access"""
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, 0o700, exist_ok=True)
+
+    # someone else could have created it first
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(f'{directory} is not a directory private to the current user')
+
+def removeStaleSocket(path):
+    """Removes a socket left behind by a daemon which didn't shut down, refuses to touch anything else"""
+
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+
+    if not stat.S_ISSOCK(st.st_mode):
+        raise RuntimeError(f'{path} exists and is not a socket')
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+
+    raise RuntimeError(f'a daemon is already listening on {path}')
+
+def getPeerUid(sock):
+    """Returns the user id of the other end of a Unix socket, or None if the platform can't tell"""
+
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _pid, uid, _gid = struct.unpack('3i', creds)
+    return uid
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        uid = getPeerUid(self.connection)
+        if uid != None and uid != os.getuid():
+            response = {'status': 'failed', 'error': 'permission denied'}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            return
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {'status': 'failed', 'error': 'invalid request'}
+            else:
+                response = self.server.daemon.handle(request)
+
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        super().__init__(path, DaemonRequestHandler)
+
+def request(message, path):
+    """Sends a request to a running daemon and returns its response"""
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        f = s.makefile('rwb')
+        f.write(json.dumps(message).encode() + b'\n')
+        f.flush()
+        return json.loads(f.readline())
+
+def serve(path=None):
+    if not path:
+        path = getSocketPath()
+        makeSocketDir(path)
+
+    removeStaleSocket(path)
+
+    server = DaemonServer(path, Daemon())
+    print(f'Listening on {path}')
+
+    sys.stdout = DaemonOutput(sys.stdout)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout = sys.stdout.stream
+        server.server_close()
+        os.unlink(path)
+
+def parseCommand(args):
+    """Turns command line arguments into a daemon request"""
+
+    command = args[0]
+    message = {'command': command, 'args': {}}
+
+    if command == 'flashloader':
+        if len(args) > 1:
+            message['args']['path'] = os.path.abspath(args[1])
+    elif command == 'flash_firmware':
+        if len(args) < 2:
+            raise ValueError('python3 stadiatool.py remote flash_firmware <firmware_signed.bin> [--delta]')
+        message['args'] = {'path': os.path.abspath(args[1]), 'delta': '--delta' in args[2:]}
+    elif command == 'dump':
+        if len(args) < 4:
+            raise ValueError('python3 stadiatool.py remote dump <start> <end> <dump.bin> [ahb/ip]')
+        message['args'] = {
+            'start': int(args[1], 0),
+            'end': int(args[2], 0),
+            'path': os.path.abspath(args[3]),
+            'mode': args[4] if len(args) > 4 else 'ahb',
+        }
+
+    return message
+
+def main(args):
+    socket_path = None
+    if '--socket' in args:
+        i = args.index('--socket')
+        socket_path = args[i + 1]
+        del args[i:i + 2]
+
+    if args and args[0] == 'daemon':
+        try:
+            serve(socket_path)
+        except RuntimeError as e:
+            print(f'Could not start daemon: {e}')
+            sys.exit(1)
+        return
+
+    device = None
+    if '--device' in args:
+        i = args.index('--device')
+        device = args[i + 1]
+        del args[i:i + 2]
+
+    if len(args) < 2:
+        print('Usage:\npython3 stadiatool.py remote [--socket <path>] [--device <path>] <list/info/flashloader/flash_firmware/dump/reset>')
+        sys.exit(1)
+
+    try:
+        message = parseCommand(args[1:])
+    except ValueError as e:
+        print('Usage:\n' + str(e))
+        sys.exit(1)
+
+    message['device'] = device
+
+    response = request(message, socket_path or getSocketPath())
+    if 'controllers' in response:
+        for c in response['controllers']:
+            print(f'{c["path"]:<12} {c["mode"]}' + (' (open)' if c['open'] else ''))
+    if response.get('output'):
+        print(response['output'])
+    if response['status'] != 'done':
+        print('Failed: ' + response['error'])
+        sys.exit(1)
@@ -0,0 +1,110 @@
+"""
+Output file of a flash dump which can be resumed.
+
+The file is preallocated and memory-mapped, chunks are read straight into
+it. A sidecar file next to it (<dump>.progress) has a bitmap of
+the chunks which are done, so an interrupted dump only has to read the
+missing chunks on the next run. The sidecar is removed once the dump is
+complete.
+"""
+
+import mmap
+import os
+import struct
+
+class DumpFile:
+    MAGIC = b'SDMP'
+    # magic, start offset, end offset, chunk size
+    HEADER = struct.Struct('<4sIII')
+
+    path = ''
+    offset = 0
+    end = 0
+    chunk_size = 0
+    num_chunks = 0
+
+    file = None
+    data = None
+    progress = None
+    bitmap = None
+    resumed = False
+
+    def __init__(self, path, offset, end, chunk_size):
+        self.path = path
+        self.offset = offset
+        self.end = end
+        self.chunk_size = chunk_size
+        self.num_chunks = (end - offset + chunk_size - 1) // chunk_size
+
+        header = DumpFile.HEADER.pack(DumpFile.MAGIC, offset, end, chunk_size)
+        self.bitmap = bytearray((self.num_chunks + 7) // 8)
+
+        # only resume a dump of the same range
+        try:
+            with open(self.progress_path(), 'rb') as f:
+                saved = f.read()
+            if saved[:len(header)] == header and len(saved) == len(header) + len(self.bitmap) \
+                    and os.path.getsize(path) == end - offset:
+                self.bitmap[:] = saved[len(header):]
+                self.resumed = True
+        except OSError:
+            pass
+
+        self.file = open(path, 'r+b' if self.resumed else 'w+b')
+        self.file.truncate(end - offset)
+        self.data = mmap.mmap(self.file.fileno(), end - offset)
+
+        self.progress = open(self.progress_path(), 'r+b' if self.resumed else 'w+b')
+        if not self.resumed:
+            self.progress.write(header + self.bitmap)
+            self.progress.flush()
+
+    def progress_path(self):
+        return self.path + '.progress'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_done(self, index):
+        return self.bitmap[index // 8] & (1 << (index % 8)) != 0
+
+    def missing_chunks(self):
+        """Returns (index, address, size) of every chunk which still has to be read"""
+        chunks = []
+        for i in range(self.num_chunks):
+            if not self.is_done(i):
+                address = self.offset + i * self.chunk_size
+                chunks.append((i, address, min(self.chunk_size, self.end - address)))
+        return chunks
+
+    def chunk_buffer(self, index):
+        """Returns a writable view of a chunk in the output file"""
+        pos = index * self.chunk_size
+        return memoryview(self.data)[pos:min(pos + self.chunk_size, self.end - self.offset)]
+
+    def mark_done(self, index):
+        # the dirty pages outlive the process, so there's no need to sync before marking the chunk as done
+        self.bitmap[index // 8] |= 1 << (index % 8)
+        self.progress.seek(DumpFile.HEADER.size + index // 8)
+        self.progress.write(self.bitmap[index // 8:index // 8 + 1])
+        self.progress.flush()
+
+    def complete(self):
+        return all([self.is_done(i) for i in range(self.num_chunks)])
+
+    def close(self):
+        if self.data:
+            self.data.flush()
+            self.data.close()
+            self.data = None
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.progress:
+            self.progress.close()
+            self.progress = None
+            if self.complete():
+                os.remove(self.progress_path())
@@ -1,4 +1,6 @@
 import hid
+import flexspi
+import ramcode
 import usb.core, usb.util
 import struct
 
@@ -34,8 +36,58 @@ class Flashloader:
     Response_FlashReadOnce      = 0xaf
     Response_FlashReadResource  = 0xb0
 
+    Property_CurrentVersion             = 0x01
+    Property_AvailableCommands          = 0x07
+    Property_MaxPacketSize              = 0x0b
+    Property_RAMStartAddress            = 0x0e
+    Property_RAMSizeInBytes             = 0x0f
+    Property_UniqueDeviceId             = 0x12
+    Property_ExternalMemoryAttributes   = 0x19
+
+    # properties queried by discover()
+    DISCOVER_PROPERTIES = [
+        Property_CurrentVersion,
+        Property_AvailableCommands,
+        Property_MaxPacketSize,
+        Property_RAMStartAddress,
+        Property_RAMSizeInBytes,
+    ]
+
+    # max payload of a single data frame, until the flashloader reports its own
+    MAX_PACKET_SIZE = 512
+
+    # memory id of the FlexSPI NOR flash
+    MEMORY_FLEXSPI_NOR = 9
+
+    # upper bound for a single FlashEraseRegion command
+    MAX_ERASE_SIZE = 0x100000
+    # worst case erase time per block in seconds
+    ERASE_TIMEOUT_PER_BLOCK = 2
+    # worst case chip erase time in seconds
+    ERASE_ALL_TIMEOUT = 200
+
     device = None
     hid = None
+    flexspi = None
+
+    # cleared once the flashloader refuses a Call command
+    call_supported = True
+    # addresses of the ramcode routines which have been uploaded
+    routines = None
+
+    # properties reported by the flashloader, None until discover() ran
+    properties = None
+    max_packet_size = MAX_PACKET_SIZE
+
+    # parameters of the last response
+    response_parameters = None
+
+    # flash geometry, updated from the configuration block once the flash is set up
+    flash_base = 0x60000000
+    flash_size = 0
+    page_size = 0x100
+    sector_size = 0x1000
+    block_size = 0x10000
 
     def __init__(self, device: usb.core.Device):
         self.device = device
@@ -43,6 +95,8 @@ class Flashloader:
             raise FlashloaderError('Not in flashloader')
 
         self.hid = hid.HID(device)
+        self.flexspi = flexspi.FlexSPI(self)
+        self.routines = set()
 
     def send_frame(self, report_id, data):
         cmd = struct.pack('<BBH', report_id, 0, len(data)) + data
@@ -56,12 +110,29 @@ class Flashloader:
         _unk0, size = struct.unpack('<BH', report[1:4])
         return (report[0], report[4:4+size])
 
+    def drain(self, quiet=.1):
+        """
+        Discards frames left over from a command which timed out, so they aren't
+        taken for the response of the next one. Returns once none arrived for quiet seconds.
+        """
+
+        while True:
+            try:
+                self.receive_frame(quiet)
+            except hid.HIDTimeoutError:
+                return
+
     def handle_response(self, resp) -> bool:
         tag, flags, _reserved, num_parameters = struct.unpack('<BBBB', resp[0:4])
         parameters = []
         for i in range(num_parameters):
             parameters += struct.unpack('<I', resp[4 + (i * 4):8 + (i * 4)])
 
+        if self.hid.tracer:
+            self.hid.tracer.event('response', tag=tag, flags=flags, parameters=parameters)
+
+        self.response_parameters = parameters
+
         if tag == Flashloader.Response_Generic:
             if parameters[0] != 0:
                 raise CommandFailedError(
@@ -74,79 +145,329 @@ class Flashloader:
                     f'ReadMemory failed with status 0x{parameters[0]:x}',
                     parameters[0]
                 )
+        elif tag == Flashloader.Response_GetProperty:
+            if parameters[0] != 0:
+                raise CommandFailedError(
+                    f'GetProperty failed with status 0x{parameters[0]:x}',
+                    parameters[0]
+                )
 
         # lowest flags bit indicates more data follows
         return flags & 1
 
-    def receive_response(self) -> bytes:
+    def receive_data(self, timeout=1):
         """
         Receives a response.
-        Returns optional data received in data stage, or raises an exepction on error.
+        Yields the data received in data stage frame by frame, or raises an exepction on error.
         """
 
-        data = b''
         while True:
-            frame = self.receive_frame(1)
-            #print(frame)
+            frame = self.receive_frame(timeout)
 
             # response
             if frame[0] == 0x03:
                 if not self.handle_response(frame[1]):
-                    return data
+                    return
 
             # data
             elif frame[0] == 0x04:
-                data += frame[1]
+                yield frame[1]
+
+    def receive_response(self, timeout=1) -> bytes:
+        """
+        Receives a response.
+        Returns optional data received in data stage, or raises an exepction on error.
+        """
+
+        data = bytearray()
+        for chunk in self.receive_data(timeout):
+            data += chunk
+
+        return bytes(data)
 
     def send_command(self, tag, flags, parameters):
+        if self.hid.tracer:
+            self.hid.tracer.event('command', tag=tag, flags=flags, parameters=parameters)
+
         cmd = struct.pack('<BBBB', tag, flags, 0, len(parameters))
         for p in parameters:
             cmd += struct.pack('<I', p)
         return self.send_frame(1, cmd)
 
-    def flash_erase_region(self, address, size):
-        # erase in 16k regions
-        while size > 0:
-            toErase = 0x4000 if size > 0x4000 else size
-            self.send_command(Flashloader.Command_FlashEraseRegion, 0, [address, toErase, 0])
-            self.receive_response()
+    def plan_erase(self, address, size):
+        """
+        Splits an erase region into as few commands as possible.
+        Sectors up to the first block boundary and after the last one are
+        erased separately, so the flashloader can use block erases for the rest.
+        Returns a list of (address, size).
+        """
+
+        end = address + size
+        plan = []
 
+        head = min(end, address + (-address % self.block_size))
+        if head > address:
+            plan.append((address, head - address))
+            address = head
+
+        blocks_end = address + (end - address) // self.block_size * self.block_size
+        while address < blocks_end:
+            toErase = min(Flashloader.MAX_ERASE_SIZE, blocks_end - address)
+            plan.append((address, toErase))
             address += toErase
-            size -= toErase
 
-    def read_memory(self, address, size):
+        if end > address:
+            plan.append((address, end - address))
+
+        return plan
+
+    def is_flash(self, address) -> bool:
+        """Returns if an address is in the flash, everything above its base while the size isn't known"""
+        return address >= self.flash_base and (not self.flash_size or address < self.flash_base + self.flash_size)
+
+    def flash_erase_region(self, address, size):
+        # the flashloader drives the erase through the FlexSPI IP command registers
+        self.flexspi.invalidate()
+
+        # erase the whole chip if the region covers it
+        if self.flash_size and address == self.flash_base and size >= self.flash_size \
+                and self.supports(Flashloader.Command_FlashEraseAll):
+            self.flash_erase_all()
+            return
+
+        for address, size in self.plan_erase(address, size):
+            self.send_command(Flashloader.Command_FlashEraseRegion, 0, [address, size, 0])
+
+            blocks = (size + self.block_size - 1) // self.block_size
+            self.receive_response(1 + blocks * Flashloader.ERASE_TIMEOUT_PER_BLOCK)
+
+    def flash_erase_all(self):
+        self.flexspi.invalidate()
+        self.send_command(Flashloader.Command_FlashEraseAll, 0, [Flashloader.MEMORY_FLEXSPI_NOR])
+        self.receive_response(Flashloader.ERASE_ALL_TIMEOUT)
+
+    def read_memory(self, address, size, sink=None):
+        """
+        Reads memory and returns it.
+        With a sink the data is passed on as it arrives instead and the number of
+        bytes read is returned. The sink is either a writable buffer (bytearray,
+        memoryview, mmap) of at least size bytes or a callable taking each chunk.
+        """
+
+        if sink == None:
+            data = bytearray(size)
+            received = self.read_memory(address, size, data)
+            del data[received:]
+            return bytes(data)
+
+        received = 0
+        if callable(sink):
+            for chunk in self.iter_memory(address, size):
+                if received + len(chunk) > size:
+                    raise FlashloaderError(f'Received more than the 0x{size:x} bytes requested')
+                sink(chunk)
+                received += len(chunk)
+            return received
+
+        with memoryview(sink) as view, view.cast('B') as buffer:
+            space = min(size, len(buffer))
+            for chunk in self.iter_memory(address, size):
+                if received + len(chunk) > space:
+                    raise FlashloaderError(f'Received more than the 0x{space:x} bytes which fit into the buffer')
+                buffer[received:received + len(chunk)] = chunk
+                received += len(chunk)
+
+        return received
+
+    def iter_memory(self, address, size):
+        """Reads memory, yields the data as it arrives"""
+
         self.send_command(Flashloader.Command_ReadMemory, 0, [address, size, 0])
-        return self.receive_response()
+        frames = self.receive_data()
+        try:
+            for chunk in frames:
+                yield chunk
+        finally:
+            # drain the data stage if the caller stopped early, the next command would get it otherwise
+            for _ in frames:
+                pass
 
     def write_memory(self, address, data):
+        # programming flash goes through the FlexSPI IP command registers
+        if self.is_flash(address):
+            self.flexspi.invalidate()
+
         self.send_command(Flashloader.Command_WriteMemory, 1, [address, len(data), 0])
         self.receive_response()
 
         # start data stage
-        # send data in 512 byte chunks (max packet size)
+        # send data in chunks of the max packet size, the device paces
+        # the transfer by NAKing the OUT endpoint so frames are sent back-to-back
+        data = memoryview(data).cast('B')
+        frame = bytearray(4 + self.max_packet_size)
+        frame_view = memoryview(frame)
         bytesSent = 0
         while (bytesSent < len(data)):
-            toSend = min(bytesSent + 512, len(data))
+            toSend = min(len(data) - bytesSent, self.max_packet_size)
+
+            struct.pack_into('<BBH', frame, 0, 2, 0, toSend)
+            frame_view[4:4+toSend] = data[bytesSent:bytesSent+toSend]
+            self.hid.write_report(frame_view[:4+toSend])
+
+            bytesSent += toSend
 
-            frame = data[bytesSent:toSend]
-            self.send_frame(2, frame)
+            # the device aborts the data stage early by sending the final response,
+            # nothing else is sent during it
+            response = self.receive_frame()
+            if response:
+                if response[0] != 0x03:
+                    raise FlashloaderError(f'Unexpected report 0x{response[0]:02x} during the WriteMemory data stage')
 
-            bytesSent = toSend
+                self.handle_response(response[1])
+                return
 
         self.receive_response()
 
     def fill_memory(self, address, size, pattern):
+        if self.is_flash(address):
+            self.flexspi.invalidate()
+
         self.send_command(Flashloader.Command_FillMemory, 0, [address, size, pattern])
         self.receive_response()
 
     def reset(self):
+        self.flexspi.invalidate()
+        self.routines = set()
         self.send_command(Flashloader.Command_Reset, 0, [])
         self.receive_response()
 
     def configure_memory(self, type, address):
+        # the flashloader reprograms FlexSPI while configuring
+        self.flexspi.invalidate()
         self.send_command(Flashloader.Command_ConfigureMemory, 0, [type, address])
         self.receive_response()
 
+    def get_property(self, tag, memory_id=0):
+        """Returns the values of a property"""
+        self.send_command(Flashloader.Command_GetProperty, 0, [tag, memory_id])
+        self.receive_response()
+        return self.response_parameters[1:]
+
+    def discover(self):
+        """
+        Queries the flashloader's properties once and adapts the transfers to them.
+        Returns a dict of the properties, ones the flashloader doesn't know are left out.
+        """
+
+        if self.properties != None:
+            return self.properties
+
+        self.properties = {}
+        for tag in Flashloader.DISCOVER_PROPERTIES:
+            try:
+                self.properties[tag] = self.get_property(tag)[0]
+            except CommandFailedError:
+                pass
+
+        if self.properties.get(Flashloader.Property_MaxPacketSize):
+            self.max_packet_size = self.properties[Flashloader.Property_MaxPacketSize]
+        if not self.supports(Flashloader.Command_Call):
+            self.call_supported = False
+
+        return self.properties
+
+    def unique_id(self):
+        """Returns the MCU's unique ID as a hex string, or None if the flashloader can't report it"""
+        try:
+            words = self.get_property(Flashloader.Property_UniqueDeviceId)
+        except CommandFailedError:
+            return None
+
+        if not words:
+            return None
+
+        return ''.join([f'{w:08x}' for w in words])
+
+    def supports(self, command) -> bool:
+        """Returns if a command is available, assumes it is if the flashloader didn't tell"""
+        commands = (self.properties or {}).get(Flashloader.Property_AvailableCommands)
+        if commands == None:
+            return True
+
+        # bit 0 is FlashEraseAll, the first command tag
+        return commands & (1 << (command - Flashloader.Command_FlashEraseAll)) != 0
+
+    def read_memory_attributes(self, memory_id=MEMORY_FLEXSPI_NOR) -> bool:
+        """
+        Updates the flash geometry from what the flashloader detected for a configured memory.
+        Returns False if it can't report it.
+        """
+
+        try:
+            flags, start, size_kb, page_size, sector_size, block_size = self.get_property(
+                Flashloader.Property_ExternalMemoryAttributes, memory_id)[0:6]
+        except (CommandFailedError, ValueError):
+            return False
+
+        # flags tell which of the attributes are valid
+        if flags & 0x01:
+            self.flash_base = start
+        if flags & 0x02 and size_kb:
+            self.flash_size = size_kb * 1024
+        if flags & 0x04 and page_size:
+            self.page_size = page_size
+        if flags & 0x08 and sector_size:
+            self.sector_size = sector_size
+        if flags & 0x10 and block_size:
+            self.block_size = block_size
+
+        return True
+
+    def load_routine(self, address, code):
+        """Uploads a ramcode routine, unless it already was in this session"""
+        if address in self.routines:
+            return
+
+        self.write_memory(address, code)
+        self.routines.add(address)
+
+    def call(self, address, argument, timeout=1) -> bool:
+        """
+        Calls a function on the device with a single argument.
+        Returns False if the flashloader doesn't allow calling it.
+        """
+
+        self.send_command(Flashloader.Command_Call, 0, [address, argument])
+        try:
+            self.receive_response(timeout)
+        except CommandFailedError:
+            self.call_supported = False
+            return False
+
+        return True
+
+    def crc32(self, address, size):
+        """
+        Computes the CRC-32 of a memory range on the device.
+        Returns None if the flashloader doesn't allow calling code.
+        """
+
+        if not self.call_supported:
+            return None
+
+        self.load_routine(ramcode.CRC32_ADDRESS, ramcode.CRC32_CODE)
+        self.write_memory(ramcode.ARGUMENT_ADDRESS, struct.pack('<III', address, size, 0))
+
+        # the bitwise routine needs well below a second per MiB
+        if not self.call(ramcode.CRC32_ADDRESS | 1, ramcode.ARGUMENT_ADDRESS, 2 + size // 0x100000):
+            return None
+
+        return self.read32(ramcode.ARGUMENT_ADDRESS + 8)
+
+    def batch(self):
+        """Returns a RegisterBatch which applies its set32 calls together"""
+        return ramcode.RegisterBatch(self)
+
     def read32(self, address):
         data = self.read_memory(address, 4)
         if len(data) != 4:
@@ -0,0 +1,73 @@
+class FlexSPI:
+    """
+    Host-side shadow of the FlexSPI register block.
+    Register values which are known are kept in the shadow, so reads and writes
+    which wouldn't change anything don't cost a flashloader round trip.
+    """
+
+    BASE = 0x402A8000
+
+    # register offsets
+    INTR        = 0x14
+    FLSHA1CR2   = 0x80
+    IPCR0       = 0xA0
+    IPCR1       = 0xA4
+    IPCMD       = 0xB0
+    IPRXFCR     = 0xB8
+    IPTXFCR     = 0xBC
+    RFDR        = 0x100
+
+    # registers which trigger an action when written or change on their own,
+    # these always go to the device. INTR has status flags which are set by
+    # hardware and cleared by writing 1, a shadowed value would be stale.
+    VOLATILE_REGISTERS = [INTR, IPCMD, IPRXFCR, IPTXFCR, RFDR]
+
+    fl = None
+    shadow = None
+
+    def __init__(self, fl):
+        self.fl = fl
+        self.shadow = {}
+
+    def invalidate(self):
+        self.shadow = {}
+
+    def read(self, reg):
+        if reg in self.shadow:
+            return self.shadow[reg]
+
+        val = self.fl.read32(FlexSPI.BASE + reg)
+        if val != None and reg not in FlexSPI.VOLATILE_REGISTERS:
+            self.shadow[reg] = val
+        return val
+
+    def write(self, reg, val, batch=None):
+        if self.shadow.get(reg) == val:
+            return
+
+        if not batch:
+            self.fl.set32(FlexSPI.BASE + reg, val)
+            self.update(reg, val)
+            return
+
+        # writes collected in a RegisterBatch only reach the shadow once they're made,
+        # until then the register is unknown in case the batch fails halfway
+        self.shadow.pop(reg, None)
+        batch.set32(FlexSPI.BASE + reg, val, lambda: self.update(reg, val))
+
+    def update(self, reg, val):
+        if reg not in FlexSPI.VOLATILE_REGISTERS:
+            self.shadow[reg] = val
+
+    def set_bits(self, reg, bits, batch=None) -> bool:
+        """
+        Read-modify-write which sets bits in a register.
+        Returns False if the current value couldn't be read.
+        """
+
+        cur = self.read(reg)
+        if cur == None:
+            return False
+
+        self.write(reg, cur | bits, batch)
+        return True
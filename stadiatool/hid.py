@@ -1,5 +1,6 @@
 import usb.core, usb.util
 import threading
+import collections
 
 class HIDError(Exception):
     """HID error"""
@@ -8,7 +9,11 @@ class HIDTimeoutError(HIDError):
     """Error if a timeout occurs"""
 
 class HID:
-    REPORT_QUEUE_SIZE = 30
+    REPORT_QUEUE_SIZE = 256
+
+    # what happens to incoming reports while the queue is full
+    OVERFLOW_DROP_OLDEST = 0
+    OVERFLOW_DROP_NEWEST = 1
 
     device = None
 
@@ -16,9 +21,17 @@ class HID:
 
     in_endpoint = None
     out_endpoint = None
+    # wMaxPacketSize of the IN endpoint, cached since it's needed for every read
+    in_packet_size = 0
+
+    report_cond = None
+    report_queue = None
+    queue_size = REPORT_QUEUE_SIZE
+    overflow_policy = OVERFLOW_DROP_OLDEST
+    dropped_reports = 0
 
-    report_ev = None
-    report_queue = []
+    # optional usbtrace.Tracer, set on the class to instrument every device
+    tracer = None
 
     def read_thread(self):
         while True:
@@ -26,25 +39,39 @@ class HID:
             try:
                 report = self.device.read(
                     self.in_endpoint.bEndpointAddress,
-                    self.in_endpoint.wMaxPacketSize,
+                    self.in_packet_size,
                     5000)
             except usb.core.USBTimeoutError:
                 # no data, try again
                 continue
-            except usb.core.USBError:
+            except usb.core.USBError as e:
+                if self.tracer:
+                    self.tracer.event('read_error', error=str(e))
                 # stop read thread on error
                 return
 
-            # make sure we don't queue up too many reports
-            if len(self.report_queue) == HID.REPORT_QUEUE_SIZE:
-                self.report_queue.pop()
+            with self.report_cond:
+                if self.tracer:
+                    self.tracer.event('report_in', id=report[0], size=len(report), queue=len(self.report_queue))
+
+                # make sure we don't queue up too many reports
+                if len(self.report_queue) >= self.queue_size:
+                    self.dropped_reports += 1
+                    if self.tracer:
+                        self.tracer.event('report_dropped', dropped=self.dropped_reports)
+                    if self.overflow_policy == HID.OVERFLOW_DROP_NEWEST:
+                        continue
 
-            # append report
-            self.report_queue.append(report)
-            self.report_ev.set()
+                    self.report_queue.popleft()
 
-    def __init__(self, device: usb.core.Device):
+                # append report
+                self.report_queue.append(report)
+                self.report_cond.notify()
+
+    def __init__(self, device: usb.core.Device, queue_size=REPORT_QUEUE_SIZE, overflow_policy=OVERFLOW_DROP_OLDEST):
         self.device = device
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
 
         # set the configuration
         self.device.set_configuration()
@@ -65,13 +92,19 @@ class HID:
         # need an in endpoint
         if not self.in_endpoint:
             raise HIDError("No IN endpoint")
-        
-        self.report_ev = threading.Event()
 
-        thread = threading.Thread(daemon=True, target=HID.read_thread, args=(self,))
-        thread.start()
+        self.in_packet_size = self.in_endpoint.wMaxPacketSize
+
+        self.report_cond = threading.Condition()
+        self.report_queue = collections.deque()
+
+        self.thread = threading.Thread(daemon=True, target=HID.read_thread, args=(self,))
+        self.thread.start()
 
     def write_report(self, report):
+        if self.tracer:
+            self.tracer.event('report_out', id=report[0], size=len(report))
+
         if self.out_endpoint:
             return self.device.write(self.out_endpoint.bEndpointAddress, report)
         else:
@@ -85,17 +118,18 @@ class HID:
             )
     
     def read_report(self, wait=None):
-        self.report_ev.clear()
-
-        # handle empty queue
-        if not self.report_queue:
-            # if we don't specify a wait time return immediately
-            if not wait:
-                return None
-
-            # wait for a report
-            if not self.report_ev.wait(wait):
-                raise HIDTimeoutError("read_report timed out, try replugging the device")
-
-        # pop report from queue
-        return self.report_queue.pop()
+        with self.report_cond:
+            # handle empty queue
+            if not self.report_queue:
+                # if we don't specify a wait time return immediately
+                if not wait:
+                    return None
+
+                # wait for a report
+                if not self.report_cond.wait_for(lambda: self.report_queue, wait):
+                    if self.tracer:
+                        self.tracer.event('timeout', wait=wait)
+                    raise HIDTimeoutError("read_report timed out, try replugging the device")
+
+            # oldest report first
+            return self.report_queue.popleft()
@@ -0,0 +1,90 @@
+"""
+Cache of firmware images keyed by their SHA-256.
+
+Images are memory-mapped on demand and hashed once per process, the most
+recently used ones are kept open. The file's timestamps aren't trusted across
+runs, a replaced image can keep size and mtime (cp -p, extracted archives).
+Per-image metadata (parsed build info, CRC-32) is stored in an index on disk
+by digest, so it's only computed once per image and not once per flashed device.
+"""
+
+import utils
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+class ImageCache:
+    CACHE_DIR = './data/cache'
+    LRU_SIZE = 4
+
+    directory = ''
+    lru_size = LRU_SIZE
+    index = None
+    images = None
+    lock = None
+
+    def __init__(self, directory=CACHE_DIR, lru_size=LRU_SIZE):
+        self.directory = directory
+        self.lru_size = lru_size
+        self.images = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.index = {'images': {}}
+
+        try:
+            with open(self.index_path(), 'r') as f:
+                self.index['images'].update(json.load(f).get('images', {}))
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def index_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # every writer gets its own temporary file, so concurrent saves can't replace each other's
+        fd, tmp = tempfile.mkstemp(prefix='index.json.', suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.index, f, indent=1)
+            os.replace(tmp, self.index_path())
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def load(self, path):
+        """
+        Maps an image file.
+        Returns (digest, data), the image is only hashed again if the file changed.
+        """
+
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        # the ctime changes whenever the file is written or replaced, it can't be set back
+        key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                return self.images[key]
+
+            # mappings which drop out of the LRU are closed once the last user lets go of them
+            data = utils.mmap_file(path)
+            digest = hashlib.sha256(data).hexdigest()
+
+            self.images[key] = (digest, data)
+            while len(self.images) > self.lru_size:
+                self.images.popitem(last=False)
+
+            return digest, data
+
+    def get_metadata(self, digest):
+        with self.lock:
+            return self.index['images'].get(digest)
+
+    def set_metadata(self, digest, metadata):
+        with self.lock:
+            self.index['images'][digest] = metadata
+            self.save()
@@ -2,6 +2,9 @@ import usb.core, usb.util
 import struct
 import time
 
+# seconds a battery measurement takes
+BATTERY_MEASURE_TIME = .1
+
 class OEMError(Exception):
     """Generic error while in OEM mode"""
 
@@ -34,16 +37,15 @@ class OEM:
         return struct.unpack('<I', fw_info[0:4])[0]
 
 
-    def get_battery_percentage(self):
-        # request battery percentage
+    def request_battery_percentage(self):
+        # start a battery measurement
         self.device.ctrl_transfer(
             usb.util.CTRL_TYPE_CLASS | usb.util.CTRL_RECIPIENT_INTERFACE | usb.util.CTRL_OUT,
             0x83
         )
 
-        time.sleep(.1)
-
-        # read battery percentage
+    def read_battery_percentage(self):
+        # read the result of the last measurement
         battery_level = self.device.ctrl_transfer(
             usb.util.CTRL_TYPE_CLASS | usb.util.CTRL_RECIPIENT_INTERFACE | usb.util.CTRL_IN,
             0x84,
@@ -56,3 +58,10 @@ class OEM:
             return None
 
         return struct.unpack('<H', battery_level)[0]
+
+    def get_battery_percentage(self):
+        self.request_battery_percentage()
+
+        time.sleep(BATTERY_MEASURE_TIME)
+
+        return self.read_battery_percentage()
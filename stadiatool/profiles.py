@@ -0,0 +1,91 @@
+"""
+Profiles of known controllers, stored on disk.
+
+A profile holds what is known about a controller (dvt/pvt, the digest of
+the last image flashed to it). Profiles are keyed by the controller's serial
+number, which is only visible in OEM mode, and looked up by USB port path in
+the other modes. A controller which hasn't been seen in OEM mode yet is keyed
+by its port path.
+
+What was detected in flashloader mode (MCU type, flash type) is kept per unit
+instead, keyed by the MCU's unique ID, since a port path can't tell apart two
+controllers plugged into the same port one after the other.
+"""
+
+import json
+import os
+import tempfile
+import threading
+
+class ProfileCache:
+    PROFILE_FILE = './data/profiles.json'
+
+    file = ''
+    index = None
+    lock = None
+
+    def __init__(self, file=PROFILE_FILE):
+        self.file = file
+        self.lock = threading.Lock()
+        self.index = {'paths': {}, 'devices': {}, 'units': {}}
+
+        try:
+            if self.file:
+                with open(self.file, 'r') as f:
+                    self.index.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        # profiles without a file only live in memory
+        if not self.file:
+            return
+
+        directory = os.path.dirname(self.file) or '.'
+        os.makedirs(directory, exist_ok=True)
+        # every writer gets its own temporary file, so concurrent saves can't replace each other's
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.file) + '.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.index, f, indent=1)
+            os.replace(tmp, self.file)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def get(self, path):
+        """Returns the profile of the controller last seen at a port path"""
+        with self.lock:
+            key = self.index['paths'].get(path)
+            profile = self.index['devices'].get(key)
+            return dict(profile) if profile else None
+
+    def update(self, path, serial=None, **values):
+        with self.lock:
+            key = self.index['paths'].get(path)
+            if serial and key != serial:
+                # a profile keyed by path belonged to this controller, a profile of another serial didn't
+                old = self.index['devices'].pop(path, {}) if key == path else {}
+                self.index['devices'][serial] = {**old, **self.index['devices'].get(serial, {})}
+                key = serial
+            elif not key:
+                key = path
+
+            self.index['paths'][path] = key
+            profile = self.index['devices'].setdefault(key, {})
+            profile.update(values)
+            if serial:
+                profile['serial'] = serial
+
+            self.save()
+
+    def get_unit(self, unit_id):
+        """Returns what was detected on the unit with an MCU unique ID"""
+        with self.lock:
+            unit = self.index['units'].get(unit_id)
+            return dict(unit) if unit else None
+
+    def update_unit(self, unit_id, **values):
+        with self.lock:
+            self.index['units'].setdefault(unit_id, {}).update(values)
+            self.save()
@@ -0,0 +1,114 @@
+"""
+Small Thumb routines which are uploaded to RAM and run with the flashloader's
+Call command, to do work on the device which would otherwise take many
+flashloader round trips.
+
+Routines follow the AAPCS, take a single pointer argument in r0 and return
+a status in r0. They are placed after the configuration block in ITCM, each
+at its own address, so they only have to be uploaded once per session.
+"""
+
+import struct
+
+# where routines are uploaded to
+REGISTER_WRITE_ADDRESS = 0x2400
+CRC32_ADDRESS = 0x2440
+# arguments of the routine being called, the register write table grows upwards from here
+ARGUMENT_ADDRESS = 0x2480
+
+def thumb(*halfwords):
+    return struct.pack(f'<{len(halfwords)}H', *halfwords)
+
+# void apply_writes(struct { uint32_t count; struct { uint32_t address, value; } writes[count]; } *table)
+REGISTER_WRITE_CODE = thumb(
+    0x6801, #       ldr     r1, [r0]        @ count
+    0x3004, #       adds    r0, #4
+    0xB129, # loop: cbz     r1, done
+    0x6802, #       ldr     r2, [r0]        @ address
+    0x6843, #       ldr     r3, [r0, #4]    @ value
+    0x6013, #       str     r3, [r2]
+    0x3008, #       adds    r0, #8
+    0x3901, #       subs    r1, #1
+    0xE7F8, #       b       loop
+    0x2000, # done: movs    r0, #0
+    0x4770, #       bx      lr
+    0x0000, #       @ padding
+)
+
+# int crc32(struct { uint32_t address, size, crc; } *params)
+# standard reflected CRC-32 (zlib), bitwise to keep it small
+CRC32_CODE = thumb(
+    0xB570, #       push    {r4, r5, r6, lr}
+    0x6801, #       ldr     r1, [r0]        @ address
+    0x6842, #       ldr     r2, [r0, #4]    @ size
+    0x2300, #       movs    r3, #0
+    0x43DB, #       mvns    r3, r3          @ crc = 0xffffffff
+    0x4C08, #       ldr     r4, poly
+    0xB152, # byte: cbz     r2, done
+    0x780D, #       ldrb    r5, [r1]
+    0x3101, #       adds    r1, #1
+    0x406B, #       eors    r3, r5
+    0x2608, #       movs    r6, #8
+    0x085B, # bit:  lsrs    r3, r3, #1
+    0xD300, #       bcc     next
+    0x4063, #       eors    r3, r4
+    0x3E01, # next: subs    r6, #1
+    0xD1FA, #       bne     bit
+    0x3A01, #       subs    r2, #1
+    0xE7F3, #       b       byte
+    0x43DB, # done: mvns    r3, r3
+    0x6083, #       str     r3, [r0, #8]    @ crc
+    0x2000, #       movs    r0, #0
+    0xBD70, #       pop     {r4, r5, r6, pc}
+) + struct.pack('<I', 0xEDB88320) # poly
+
+class RegisterBatch:
+    """
+    Collects 32-bit register writes and applies them in order with a single
+    WriteMemory and Call, instead of one FillMemory command per write.
+    Falls back to individual writes if the flashloader refuses the Call command.
+    """
+
+    # batches this small are cheaper as individual writes
+    MIN_BATCH_SIZE = 3
+
+    fl = None
+    writes = None
+
+    def __init__(self, fl):
+        self.fl = fl
+        self.writes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # writes of a failed block are dropped
+        if exc_type == None:
+            self.apply()
+
+    def set32(self, address, value, applied=None):
+        """Queues a write, applied is called once it has been made"""
+        self.writes.append((address, value, applied))
+
+    def apply(self):
+        writes = self.writes
+        self.writes = []
+
+        if len(writes) >= RegisterBatch.MIN_BATCH_SIZE and self.fl.call_supported:
+            table = struct.pack('<I', len(writes))
+            for address, value, _ in writes:
+                table += struct.pack('<II', address, value)
+
+            self.fl.load_routine(REGISTER_WRITE_ADDRESS, REGISTER_WRITE_CODE)
+            self.fl.write_memory(ARGUMENT_ADDRESS, table)
+            if self.fl.call(REGISTER_WRITE_ADDRESS | 1, ARGUMENT_ADDRESS):
+                for _, _, applied in writes:
+                    if applied:
+                        applied()
+                return
+
+        for address, value, applied in writes:
+            self.fl.set32(address, value)
+            if applied:
+                applied()
@@ -14,6 +14,9 @@ class SDP:
     COMMAND_DCD_WRITE       = 0x0a0a
     COMMAND_JUMP_ADDRESS    = 0x0b0b
 
+    # data stage report payload size
+    MAX_PACKET_SIZE = 1024
+
     device = None
     hid = None
 
@@ -24,7 +27,34 @@ class SDP:
 
         self.hid = hid.HID(device)
 
+    @staticmethod
+    def file_reports(data):
+        """
+        Yields the data stage reports of a WRITE_FILE command.
+        All reports share one buffer, a report is only valid until the next one is requested.
+        """
+
+        # send data in 1024 byte chunks (max packet size)
+        data = memoryview(data).cast('B')
+        report = bytearray(1 + SDP.MAX_PACKET_SIZE)
+        report[0] = 0x02
+        report_view = memoryview(report)
+        bytesSent = 0
+        while (bytesSent < len(data)):
+            toSend = min(len(data) - bytesSent, SDP.MAX_PACKET_SIZE)
+
+            report_view[1:1+toSend] = data[bytesSent:bytesSent+toSend]
+            # pad the last report
+            if toSend < SDP.MAX_PACKET_SIZE:
+                report_view[1+toSend:] = bytes(SDP.MAX_PACKET_SIZE - toSend)
+
+            yield report_view
+            bytesSent += toSend
+
     def send_command(self, type, address, format, data_count, data):
+        if self.hid.tracer:
+            self.hid.tracer.event('command', type=type, address=address, data_count=data_count)
+
         report = struct.pack(
             '>BHIBIIB',
             1, # report id
@@ -49,16 +79,8 @@ class SDP:
         )
 
         # start data stage
-        # send data in 1024 byte chunks (max packet size)
-        bytesSent = 0
-        while (bytesSent < len(data)):
-            toSend = min(bytesSent + 1024, len(data))
-
-            report = data[bytesSent:toSend]
-            report += b'\0' * (1024 - len(report))
-            self.hid.write_report(b'\x02' + report)
-
-            bytesSent = toSend
+        for report in SDP.file_reports(data):
+            self.hid.write_report(report)
 
         # wait for result response
         while True:
@@ -0,0 +1,749 @@
+"""
+Software stand-in for a Stadia Controller.
+
+SimulatedDevice can be used wherever a usb.core.Device is expected. It
+emulates the OEM control transfers, the SDP HID protocol of the boot ROM and
+the flashloader HID protocol against an in-memory 16 MiB flash and a small
+FlexSPI register model. A configurable latency is added to every transfer.
+"""
+
+import ramcode
+import usb.core, usb.util
+import array
+import collections
+import struct
+import threading
+import time
+import zlib
+
+MODE_IDS = {
+    'oem': (0x18d1, 0x9400),
+    'bootloader': (0x18d1, 0x946b),
+    'sdp': (0x1fc9, 0x0135),
+    'flashloader': (0x15a2, 0x0073),
+}
+
+MODE_STRINGS = {
+    'oem': ('Google LLC', 'Stadia Controller rev. A'),
+    'bootloader': ('Google LLC', 'Stadia Controller bootloader'),
+    'sdp': ('NXP SemiConductor Inc', 'SE Blank RT Family'),
+    'flashloader': ('NXP Semiconductors', 'Kinetis Bootloader'),
+}
+
+# flashloader status codes
+STATUS_SUCCESS              = 0
+STATUS_INVALID_ARGUMENT     = 4
+STATUS_ALIGNMENT_ERROR      = 101
+STATUS_UNKNOWN_COMMAND      = 10000
+STATUS_MEMORY_RANGE_INVALID = 10200
+STATUS_NOT_CONFIGURED       = 10204
+STATUS_UNKNOWN_PROPERTY     = 10300
+
+# SDP status words
+SDP_HAB_OPEN        = 0x56787856
+SDP_WRITE_COMPLETE  = 0x88888888
+SDP_WRITE_OK        = 0x128A8A12
+
+FLASH_BASE = 0x60000000
+FLEXSPI_BASE = 0x402A8000
+FCB_TAG = 0x42464346
+
+def make_fcb(read_id=False, flash_size=0x1000000, page_size=0x100, sector_size=0x1000, block_size=0x10000):
+    """
+    Builds a minimal FlexSPI NOR configuration block, enough for the simulator
+    to tell a get_vendor_id block from a regular one.
+    """
+
+    fcb = bytearray(0x200)
+    struct.pack_into('<II', fcb, 0, FCB_TAG, 0x56010400)
+    struct.pack_into('<I', fcb, 0x50, flash_size)
+    # LUT sequence 0, CMD_SDR with either Read Manufacturer/Device ID or Fast Read Quad I/O
+    opcode = 0x90 if read_id else 0xEB
+    struct.pack_into('<I', fcb, 0x80, 0x18000000 | (0x01 << 10) | opcode)
+    struct.pack_into('<II', fcb, 0x1c0, page_size, sector_size)
+    struct.pack_into('<I', fcb, 0x1d0, block_size)
+    return bytes(fcb)
+
+class SimulatedEndpoint:
+    bEndpointAddress = 0
+    bmAttributes = usb.util.ENDPOINT_TYPE_INTR
+    wMaxPacketSize = 1024
+
+    def __init__(self, address):
+        self.bEndpointAddress = address
+
+class SimulatedInterface:
+    bInterfaceNumber = 0
+    bInterfaceClass = 3
+    endpoints = None
+
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+
+    def __iter__(self):
+        return iter(self.endpoints)
+
+class SimulatedConfiguration:
+    bConfigurationValue = 1
+    interfaces = None
+
+    def __init__(self, interfaces):
+        self.interfaces = interfaces
+
+    def __iter__(self):
+        return iter(self.interfaces)
+
+class SimulatedBus:
+    """Backend over the simulated controllers, set it as transport.backend to use it in place of usb"""
+
+    controllers = None
+    next_address = 0
+    lock = None
+
+    def __init__(self):
+        self.controllers = []
+        self.lock = threading.Lock()
+
+    def allocate_address(self):
+        """Returns the next device address, like a host every enumeration gets a new one"""
+        with self.lock:
+            self.next_address = self.next_address % 127 + 1
+            return self.next_address
+
+    def devices(self):
+        return [c.device for c in self.controllers if c.device]
+
+    def find(self, find_all=False, custom_match=None, **args):
+        def match(dev):
+            return all([getattr(dev, k) == v for k, v in args.items()]) and (custom_match == None or custom_match(dev))
+
+        devices = [dev for dev in self.devices() if match(dev)]
+        if find_all:
+            return iter(devices)
+
+        return devices[0] if devices else None
+
+    def close(self):
+        pass
+
+bus = SimulatedBus()
+
+class SimulatedDevice:
+    """One enumeration of a simulated controller"""
+
+    controller = None
+    mode = ''
+    connected = True
+
+    idVendor = 0
+    idProduct = 0
+    serial_number = ''
+    manufacturer = ''
+    product = ''
+    bus = 1
+    address = 0
+    port_numbers = None
+
+    in_queue = None
+    in_cond = None
+    configuration = None
+    # usbhid is bound to the interface until it's detached
+    kernel_driver_active = False
+
+    def __init__(self, controller, mode, address):
+        self.controller = controller
+        self.mode = mode
+        self.kernel_driver_active = controller.kernel_driver
+        self.idVendor, self.idProduct = MODE_IDS[mode]
+        self.manufacturer, self.product = MODE_STRINGS[mode]
+        self.serial_number = controller.serial_number
+        self.bus = controller.bus
+        self.port_numbers = controller.port_numbers
+        self.address = address
+
+        self.in_queue = collections.deque()
+        self.in_cond = threading.Condition()
+
+        endpoints = [SimulatedEndpoint(0x81)]
+        # the boot ROM only has an IN endpoint, reports are sent with SET_REPORT
+        if mode != 'sdp':
+            endpoints.append(SimulatedEndpoint(0x02))
+        self.configuration = SimulatedConfiguration([SimulatedInterface(endpoints)])
+
+    def check_connected(self):
+        if not self.connected:
+            raise usb.core.USBError('No such device (it may have been disconnected)', None, 19)
+
+    def set_configuration(self, configuration=None):
+        self.check_connected()
+
+    def get_active_configuration(self):
+        return self.configuration
+
+    def check_claimable(self):
+        if self.kernel_driver_active:
+            raise usb.core.USBError('Resource busy', None, 16)
+
+    def is_kernel_driver_active(self, interface):
+        return self.kernel_driver_active
+
+    def detach_kernel_driver(self, interface):
+        self.kernel_driver_active = False
+
+    def disconnect(self):
+        with self.in_cond:
+            self.connected = False
+            self.in_cond.notify_all()
+
+    def queue_report(self, report):
+        with self.in_cond:
+            self.in_queue.append(array.array('B', report))
+            self.in_cond.notify()
+
+    def transfer(self, direction, size):
+        self.controller.count_transfer(direction, size)
+        self.controller.count_time(self.controller.latency)
+        if self.controller.latency:
+            time.sleep(self.controller.latency)
+
+    def write(self, endpoint, data, timeout=None):
+        self.check_connected()
+        self.check_claimable()
+        data = bytes(data)
+        self.transfer('out', len(data))
+        self.controller.handle_report(self, data)
+        return len(data)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        self.check_claimable()
+        with self.in_cond:
+            deadline = time.monotonic() + (timeout / 1000 if timeout else 1)
+            while not self.in_queue:
+                self.check_connected()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise usb.core.USBTimeoutError('Operation timed out', None, 110)
+                self.in_cond.wait(remaining)
+
+            report = self.in_queue.popleft()
+
+        self.transfer('in', len(report))
+        return report
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        self.check_connected()
+        if bmRequestType & 0x1f == usb.util.CTRL_RECIPIENT_INTERFACE:
+            self.check_claimable()
+
+        if bmRequestType & usb.util.CTRL_IN:
+            self.controller.count_command()
+            data = self.controller.handle_ctrl_in(self, bRequest, data_or_wLength or 0)
+            self.transfer('in', len(data))
+            return array.array('B', data)
+
+        data = bytes(data_or_wLength or b'')
+        self.transfer('out', len(data))
+        # SET_REPORT
+        if bRequest == 0x09:
+            self.controller.handle_report(self, data)
+        else:
+            self.controller.count_command()
+            self.controller.handle_ctrl_out(self, bRequest, data)
+        return len(data)
+
+class Memory:
+    """Sparse memory map made of RAM regions"""
+
+    regions = None
+
+    def __init__(self):
+        self.regions = []
+
+    def add(self, base, size, fill=0):
+        self.regions.append((base, bytearray([fill]) * size))
+
+    def find(self, address, size):
+        for base, data in self.regions:
+            if base <= address and address + size <= base + len(data):
+                return base, data
+        return None, None
+
+    def read(self, address, size):
+        base, data = self.find(address, size)
+        if data == None:
+            return None
+        return bytes(data[address - base:address - base + size])
+
+    def write(self, address, value):
+        base, data = self.find(address, len(value))
+        if data == None:
+            return False
+        data[address - base:address - base + len(value)] = value
+        return True
+
+class SimulatedController:
+    """State of one physical controller, survives re-enumeration"""
+
+    MCU_TYPE = 0x6C0001
+
+    serial_number = ''
+    bus = 1
+    port_numbers = None
+    device = None
+
+    firmware_version = 0
+    battery_level = 0
+    battery_delay = 0
+    battery_ready = 0
+
+    latency = 0
+    # every enumeration starts out with usbhid bound, like on Linux
+    kernel_driver = True
+    call_supported = True
+    max_packet_size = 512
+    flashloader_version = 0x4B010500
+    # OCOTP unique ID, derived from the serial number
+    unique_id = None
+    sector_erase_time = 0
+    block_erase_time = 0
+    reenumerate_delay = 0
+
+    flash_id = 0
+    flash = None
+    memory = None
+    registers = None
+
+    # flash configuration set by ConfigureMemory
+    configured = False
+    read_id_mode = False
+    sector_size = 0x1000
+    block_size = 0x10000
+
+    # pending data stages
+    write_stage = None
+    sdp_stage = None
+
+    stats = None
+    lock = None
+
+    def __init__(self, serial_number='9A010000000000', port_numbers=(1,), bus_number=1, mode='oem',
+            flash_id=0x17EF, firmware_version=320480, battery_level=87, latency=0, attach=True, kernel_driver=True):
+        self.serial_number = serial_number
+        self.unique_id = [zlib.crc32(serial_number.encode()), zlib.crc32(serial_number.encode()[::-1])]
+        self.port_numbers = tuple(port_numbers)
+        self.bus = bus_number
+        self.flash_id = flash_id
+        self.firmware_version = firmware_version
+        self.battery_level = battery_level
+        self.latency = latency
+        self.kernel_driver = kernel_driver
+        self.battery_delay = .02
+
+        self.flash = bytearray(b'\xff') * 0x1000000
+        self.memory = Memory()
+        self.memory.add(0x00000000, 0x20000) # ITCM
+        self.memory.add(0x20000000, 0x20000) # DTCM
+        self.memory.add(0x20200000, 0x80000) # OCRAM
+        self.memory.add(0x400F8000, 0x100)   # IOMUXC GPR
+        self.registers = {}
+
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+        self.device = SimulatedDevice(self, mode, bus.allocate_address())
+        if attach:
+            bus.controllers.append(self)
+
+    def detach(self):
+        if self.device:
+            self.device.disconnect()
+        if self in bus.controllers:
+            bus.controllers.remove(self)
+
+    def reset_stats(self):
+        # device_seconds is the modeled time of the transfers and flash operations,
+        # it only depends on what was sent and not on how fast the host is
+        self.stats = {'out': 0, 'in': 0, 'bytes_out': 0, 'bytes_in': 0, 'commands': 0, 'device_seconds': 0}
+
+    def count_transfer(self, direction, size):
+        with self.lock:
+            self.stats[direction] += 1
+            self.stats['bytes_' + direction] += size
+
+    def count_command(self):
+        with self.lock:
+            self.stats['commands'] += 1
+
+    def count_time(self, seconds):
+        with self.lock:
+            self.stats['device_seconds'] += seconds
+
+    def reenumerate(self, mode):
+        """Disconnects the current device and attaches it again in another mode"""
+        self.device.disconnect()
+        self.device = None
+        self.write_stage = None
+        self.sdp_stage = None
+
+        def attach():
+            self.device = SimulatedDevice(self, mode, bus.allocate_address())
+
+        if self.reenumerate_delay:
+            threading.Timer(self.reenumerate_delay, attach).start()
+        else:
+            attach()
+
+    # OEM
+
+    def handle_ctrl_in(self, dev, request, length):
+        if dev.mode != 'oem':
+            raise usb.core.USBError('Pipe error', None, 32)
+
+        # firmware info
+        if request == 0x81:
+            return struct.pack('<I', self.firmware_version) + bytes(60)
+
+        # battery percentage, only available once measured
+        if request == 0x84:
+            if not self.battery_ready or time.monotonic() < self.battery_ready:
+                raise usb.core.USBError('Pipe error', None, 32)
+            return struct.pack('<H', self.battery_level)
+
+        raise usb.core.USBError('Pipe error', None, 32)
+
+    def handle_ctrl_out(self, dev, request, data):
+        # request battery measurement
+        if dev.mode == 'oem' and request == 0x83:
+            self.battery_ready = time.monotonic() + self.battery_delay
+            return
+
+        raise usb.core.USBError('Pipe error', None, 32)
+
+    def handle_report(self, dev, report):
+        if dev.mode == 'sdp':
+            self.handle_sdp_report(dev, report)
+        elif dev.mode == 'flashloader':
+            self.handle_flashloader_report(dev, report)
+        else:
+            raise usb.core.USBError('Pipe error', None, 32)
+
+    # memory access shared by SDP and flashloader
+
+    def read_memory(self, address, size):
+        if address >= FLASH_BASE and address + size <= FLASH_BASE + len(self.flash):
+            if not self.configured:
+                return None
+            return bytes(self.flash[address - FLASH_BASE:address - FLASH_BASE + size])
+
+        if address == 0x400D8260 and size == 4:
+            return struct.pack('<I', SimulatedController.MCU_TYPE)
+
+        if address >= FLEXSPI_BASE and address + size <= FLEXSPI_BASE + 0x200:
+            if address % 4 or size % 4:
+                return None
+            return b''.join([struct.pack('<I', self.read_register(a - FLEXSPI_BASE)) for a in range(address, address + size, 4)])
+
+        return self.memory.read(address, size)
+
+    def write_memory(self, address, data):
+        if address >= FLASH_BASE and address + len(data) <= FLASH_BASE + len(self.flash):
+            if not self.configured:
+                return False
+            # programming can only clear bits
+            offset = address - FLASH_BASE
+            for i in range(len(data)):
+                self.flash[offset + i] &= data[i]
+            self.flashloader_ip_command(offset + len(data) - 1, 0x100)
+            return True
+
+        if address >= FLEXSPI_BASE and address + len(data) <= FLEXSPI_BASE + 0x200:
+            if address % 4 or len(data) % 4:
+                return False
+            for i in range(0, len(data), 4):
+                self.write_register(address - FLEXSPI_BASE + i, struct.unpack('<I', data[i:i+4])[0])
+            return True
+
+        return self.memory.write(address, data)
+
+    # FlexSPI register model
+
+    def read_register(self, reg):
+        return self.registers.get(reg, 0)
+
+    def write_register(self, reg, val):
+        # INTR is write 1 to clear
+        if reg == 0x14:
+            self.registers[reg] = self.read_register(reg) & ~val
+            return
+
+        self.registers[reg] = val
+
+        # IPCMD, start the IP command
+        if reg == 0xB0 and val & 1:
+            self.run_ip_command()
+
+    def run_ip_command(self):
+        address = self.read_register(0xA0)
+        size = self.read_register(0xA4) & 0xffff
+
+        if self.read_id_mode:
+            data = struct.pack('<H', self.flash_id)
+        else:
+            data = bytes(self.flash[address:address + size])
+        data = (data + bytes(0x80))[:0x80]
+
+        # fill RFDR
+        for i in range(0, 0x80, 4):
+            self.registers[0x100 + i] = struct.unpack('<I', data[i:i+4])[0]
+
+        # INTR.IPCMDDONE
+        self.registers[0x14] = self.read_register(0x14) | 1
+
+    def flashloader_ip_command(self, offset, size):
+        """The flashloader erases and programs with IP commands, which leave their address and size behind"""
+        self.registers[0xA0] = offset
+        self.registers[0xA4] = size & 0xffff
+
+    def configure_flash(self, address):
+        config = self.read_memory(address, 0x200)
+        if config == None:
+            return STATUS_MEMORY_RANGE_INVALID
+
+        tag, = struct.unpack('<I', config[0:4])
+        if tag == FCB_TAG:
+            lut0, = struct.unpack('<I', config[0x80:0x84])
+            self.read_id_mode = lut0 & 0xff == 0x90
+            self.sector_size, = struct.unpack('<I', config[0x1c4:0x1c8])
+            self.block_size, = struct.unpack('<I', config[0x1d0:0x1d4])
+        elif tag >> 28 == 0xC:
+            # option word, the flashloader probes the flash on its own
+            self.read_id_mode = False
+            self.sector_size = 0x1000
+            self.block_size = 0x10000
+        else:
+            return STATUS_INVALID_ARGUMENT
+
+        self.configured = True
+        return STATUS_SUCCESS
+
+    def erase_flash(self, address, size):
+        if not self.configured:
+            return STATUS_NOT_CONFIGURED
+        if address < FLASH_BASE or address + size > FLASH_BASE + len(self.flash):
+            return STATUS_MEMORY_RANGE_INVALID
+        if address % self.sector_size:
+            return STATUS_ALIGNMENT_ERROR
+
+        start = address - FLASH_BASE
+        end = start + size
+        end += -end % self.sector_size
+
+        # whole blocks are erased with block erases
+        erase_time = 0
+        pos = start
+        while pos < end:
+            if pos % self.block_size == 0 and end - pos >= self.block_size:
+                erase_time += self.block_erase_time
+                pos += self.block_size
+            else:
+                erase_time += self.sector_erase_time
+                pos += self.sector_size
+
+        self.count_time(erase_time)
+        if erase_time:
+            time.sleep(erase_time)
+
+        self.flash[start:end] = b'\xff' * (end - start)
+        self.flashloader_ip_command(end - self.sector_size, 0)
+        return STATUS_SUCCESS
+
+    # flashloader
+
+    def send_frame(self, dev, report_id, data):
+        dev.queue_report(struct.pack('<BBH', report_id, 0, len(data)) + data)
+
+    def send_response(self, dev, tag, flags, parameters):
+        response = struct.pack('<BBBB', tag, flags, 0, len(parameters))
+        for p in parameters:
+            response += struct.pack('<I', p)
+        self.send_frame(dev, 0x03, response)
+
+    def send_generic_response(self, dev, status, command):
+        self.send_response(dev, 0xa0, 0, [status, command])
+
+    def handle_flashloader_report(self, dev, report):
+        report_id = report[0]
+        size, = struct.unpack('<H', report[2:4])
+        payload = report[4:4+size]
+
+        if report_id == 0x02:
+            self.handle_data_frame(dev, payload)
+            return
+
+        if report_id != 0x01:
+            return
+
+        self.count_command()
+        tag, flags, _reserved, num_parameters = struct.unpack('<BBBB', payload[0:4])
+        parameters = list(struct.unpack(f'<{num_parameters}I', payload[4:4 + num_parameters * 4]))
+
+        handler = getattr(self, f'command_{tag:02x}', None)
+        if not handler:
+            self.send_generic_response(dev, STATUS_UNKNOWN_COMMAND, tag)
+            return
+
+        handler(dev, flags, parameters)
+
+    def handle_data_frame(self, dev, data):
+        if not self.write_stage:
+            return
+
+        self.write_stage['data'] += data
+        if len(self.write_stage['data']) < self.write_stage['size']:
+            return
+
+        stage = self.write_stage
+        self.write_stage = None
+        status = STATUS_SUCCESS
+        if not self.write_memory(stage['address'], bytes(stage['data'][:stage['size']])):
+            status = STATUS_MEMORY_RANGE_INVALID
+        self.send_generic_response(dev, status, 0x04)
+
+    # FlashEraseAll
+    def command_01(self, dev, flags, parameters):
+        status = self.erase_flash(FLASH_BASE, len(self.flash))
+        self.send_generic_response(dev, status, 0x01)
+
+    # FlashEraseRegion
+    def command_02(self, dev, flags, parameters):
+        address, size = parameters[0:2]
+        status = self.erase_flash(address, size)
+        self.send_generic_response(dev, status, 0x02)
+
+    # ReadMemory
+    def command_03(self, dev, flags, parameters):
+        address, size = parameters[0:2]
+        data = self.read_memory(address, size)
+        if data == None:
+            self.send_response(dev, 0xa3, 0, [STATUS_MEMORY_RANGE_INVALID, 0])
+            return
+
+        self.send_response(dev, 0xa3, 1, [STATUS_SUCCESS, size])
+        for i in range(0, size, self.max_packet_size):
+            self.send_frame(dev, 0x04, data[i:i+self.max_packet_size])
+        self.send_generic_response(dev, STATUS_SUCCESS, 0x03)
+
+    # WriteMemory
+    def command_04(self, dev, flags, parameters):
+        address, size = parameters[0:2]
+        if self.read_memory(address, size) == None:
+            self.send_generic_response(dev, STATUS_MEMORY_RANGE_INVALID, 0x04)
+            return
+
+        self.write_stage = {'address': address, 'size': size, 'data': bytearray()}
+        self.send_generic_response(dev, STATUS_SUCCESS, 0x04)
+
+    # FillMemory
+    def command_05(self, dev, flags, parameters):
+        address, size, pattern = parameters[0:3]
+        data = (struct.pack('<I', pattern) * ((size + 3) // 4))[:size]
+        status = STATUS_SUCCESS if self.write_memory(address, data) else STATUS_MEMORY_RANGE_INVALID
+        self.send_generic_response(dev, status, 0x05)
+
+    # GetProperty
+    def command_07(self, dev, flags, parameters):
+        tag, memory_id = (parameters + [0])[0:2]
+
+        # commands with a handler, bit 0 is FlashEraseAll
+        commands = 0
+        for command in range(0x01, 0x20):
+            if hasattr(self, f'command_{command:02x}') and (command != 0x0a or self.call_supported):
+                commands |= 1 << (command - 1)
+
+        values = {
+            0x01: [self.flashloader_version],
+            0x07: [commands],
+            0x0b: [self.max_packet_size],
+            0x0e: [0x20000000],
+            0x0f: [0x20000],
+            0x12: self.unique_id,
+        }.get(tag)
+
+        if tag == 0x19 and memory_id == 9 and self.configured:
+            values = [0x1f, FLASH_BASE, len(self.flash) // 1024, 0x100, self.sector_size, self.block_size]
+
+        if values == None:
+            self.send_response(dev, 0xa7, 0, [STATUS_UNKNOWN_PROPERTY])
+            return
+
+        self.send_response(dev, 0xa7, 0, [STATUS_SUCCESS] + values)
+
+    # Call, the known ramcode routines are emulated
+    def command_0a(self, dev, flags, parameters):
+        address, argument = parameters[0:2]
+        address &= ~1
+
+        status = STATUS_INVALID_ARGUMENT
+        if not self.call_supported:
+            pass
+        elif self.memory.read(address, len(ramcode.REGISTER_WRITE_CODE)) == ramcode.REGISTER_WRITE_CODE:
+            count, = struct.unpack('<I', self.memory.read(argument, 4))
+            for i in range(count):
+                reg, value = struct.unpack('<II', self.memory.read(argument + 4 + i * 8, 8))
+                self.write_memory(reg, struct.pack('<I', value))
+            status = STATUS_SUCCESS
+        elif self.memory.read(address, len(ramcode.CRC32_CODE)) == ramcode.CRC32_CODE:
+            start, size = struct.unpack('<II', self.memory.read(argument, 8))
+            self.memory.write(argument + 8, struct.pack('<I', zlib.crc32(self.read_memory(start, size))))
+            status = STATUS_SUCCESS
+
+        self.send_generic_response(dev, status, 0x0a)
+
+    # Reset
+    def command_0b(self, dev, flags, parameters):
+        self.send_generic_response(dev, STATUS_SUCCESS, 0x0b)
+        self.configured = False
+        self.reenumerate('oem')
+
+    # ConfigureMemory
+    def command_11(self, dev, flags, parameters):
+        memory_id, address = parameters[0:2]
+        status = self.configure_flash(address) if memory_id == 9 else STATUS_INVALID_ARGUMENT
+        self.send_generic_response(dev, status, 0x11)
+
+    # SDP
+
+    def send_sdp_status(self, dev, status):
+        dev.queue_report(struct.pack('>BI', 0x03, SDP_HAB_OPEN))
+        dev.queue_report(struct.pack('>BI', 0x04, status) + bytes(60))
+
+    def handle_sdp_report(self, dev, report):
+        if report[0] == 0x02:
+            if not self.sdp_stage:
+                return
+
+            stage = self.sdp_stage
+            toWrite = min(len(report) - 1, stage['size'] - stage['written'])
+            self.memory.write(stage['address'] + stage['written'], report[1:1+toWrite])
+            stage['written'] += toWrite
+            if stage['written'] >= stage['size']:
+                self.sdp_stage = None
+                self.send_sdp_status(dev, SDP_WRITE_COMPLETE)
+            return
+
+        if report[0] != 0x01:
+            return
+
+        self.count_command()
+        _id, type, address, format, data_count, _data, _reserved = struct.unpack('>BHIBIIB', report[0:17])
+        if type == 0x0404: # WRITE_FILE
+            self.sdp_stage = {'address': address, 'size': data_count, 'written': 0}
+        elif type == 0x0202: # WRITE_REGISTER
+            self.send_sdp_status(dev, SDP_WRITE_OK)
+        elif type == 0x0101: # READ_REGISTER
+            data = self.memory.read(address, max(data_count, 4)) or bytes(4)
+            dev.queue_report(struct.pack('>BI', 0x03, SDP_HAB_OPEN))
+            dev.queue_report(b'\x04' + data[:64] + bytes(64 - len(data[:64])))
+        elif type == 0x0b0b: # JUMP_ADDRESS
+            dev.queue_report(struct.pack('>BI', 0x03, SDP_HAB_OPEN))
+            self.reenumerate('flashloader')
@@ -1,8 +1,22 @@
 #!/usr/bin/env python3
 import usb.core, usb.util
-import utils, oem, sdp, flashloader
+import utils, oem, sdp, flashloader, hid, usbtrace, imagecache, dumpfile, profiles, transport
+from flexspi import FlexSPI
 import sys
 import struct
+import time
+import zlib
+import os
+import threading
+
+# station, daemon and telemetry import stadiatool, when it's run as a script they
+# have to get this module instead of a second copy with its own caches and settings
+if __name__ == '__main__':
+    sys.modules['stadiatool'] = sys.modules[__name__]
+
+# the fcb parser lives next to stadiatool in this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fcb_parser'))
+import fcb_parser
 
 deviceFilters = [
     # flashloader
@@ -37,6 +51,38 @@ flashTypes = {
     0x17EF: 'Winbond-16m',
 }
 
+# size of a single ReadMemory command while dumping
+dumpChunkSize = 0x10000
+# chunk size when reading single words with IP commands
+ipDumpChunkSize = 0x100
+# retries per dump and delta comparison chunk, the delay doubles after each one
+dumpRetries = 8
+dumpRetryDelay = .1
+dumpRetryMaxDelay = 5
+
+# flash is erased and programmed in windows of this size, rounded to whole erase blocks
+flashWindowSize = 0x40000
+
+imageCache = None
+deviceProfiles = None
+# the caches are created on first use, which can happen on several threads in station and daemon mode
+cacheLock = threading.Lock()
+
+def getDeviceProfiles():
+    global deviceProfiles
+    with cacheLock:
+        if not deviceProfiles:
+            deviceProfiles = profiles.ProfileCache()
+        return deviceProfiles
+
+def setDeviceProfiles(cache):
+    global deviceProfiles
+    with cacheLock:
+        deviceProfiles = cache
+
+def getFirmwareName(fw_ver):
+    return 'gotham' if fw_ver < 320480 else 'bruce'
+
 def printInfo(dev):
     _oem = oem.OEM(dev)
     print('Controller serial number: ' + dev.serial_number)
@@ -53,28 +99,30 @@ def printInfo(dev):
         device_type = 'pvt'
 
     print('Controller is a ' + device_type + ' device')
+    getDeviceProfiles().update(getDevicePath(dev), dev.serial_number, device_type=device_type)
 
     fw_ver = _oem.get_firmware_version()
-    fw_name = 'gotham' if fw_ver < 320480 else 'bruce'
-    print(f'Current firmware is {fw_name} build {fw_ver}')
+    print(f'Current firmware is {getFirmwareName(fw_ver)} build {fw_ver}')
 
     battery_level = _oem.get_battery_percentage()
     print(f'Current battery level: {battery_level}%')
 
-def loadFlashloader(dev):
-    fl = b''
-    if len(sys.argv) < 3:
-        fl = utils.get_data_file('restricted_ivt_flashloader.bin')
+def loadFlashloader(dev, path=None):
+    if not path:
+        mapping = utils.map_data_file('restricted_ivt_flashloader.bin')
     else:
-        fl = utils.get_file(sys.argv[2])
+        mapping = utils.map_file(path)
 
-    print(f'flashloader image is {len(fl)} bytes')
+    with mapping as fl:
+        print(f'flashloader image is {len(fl)} bytes')
 
-    _sdp = sdp.SDP(dev)
+        _sdp = sdp.SDP(dev)
 
-    # write file to memory
-    result = _sdp.write_file(0x20000000, fl)
-    print(f'SDP load result: 0x{result:08x}')
+        # write file to memory
+        start = time.monotonic()
+        result = _sdp.write_file(0x20000000, fl)
+        print('Uploaded ' + utils.format_throughput(len(fl), time.monotonic() - start))
+        print(f'SDP load result: 0x{result:08x}')
 
     # jump to loaded file
     _sdp.jump_address(0x20000400)
@@ -86,44 +134,75 @@ def detectMCUType(fl):
         sys.exit(1)
 
     print(f'MCU: {mcu_type:x} ({mcuTypes[mcu_type]})')
+    return mcu_type
 
 class ReadFailedException(Exception):
     """Exception while reading"""
 
-def writeFlashRegister(fl, reg, val, mask=False):
+def writeFlashRegister(fl, reg, val, mask=False, batch=None):
     if mask:
-        cur = fl.read32(0x402A8000 + reg)
-        if cur == None:
+        if not fl.flexspi.set_bits(reg, val, batch):
             raise ReadFailedException("Failed to read register for masking")
+        return
 
-        val = cur | val
-        if val == cur:
-            return
-
-    fl.set32(0x402A8000 + reg, val)
+    fl.flexspi.write(reg, val, batch)
 
 def flashRead32(fl, offset, size):
-    # FLSHCR2 |= 0x80000000
-    writeFlashRegister(fl, 0x80, 0x80000000, True)
-    # INTR |= 0x1e
-    writeFlashRegister(fl, 0x14, 0x1e, True)
-    # IPCR0 = offset
-    writeFlashRegister(fl, 0xA0, offset)
-    # IPRXFCR = 1
-    writeFlashRegister(fl, 0xB8, 1)
-    # IPTXFCR = 1
-    writeFlashRegister(fl, 0xBC, 1)
-    # seqId 0 == read/device_id depending on configuration block
-    # IPCR1 = FLEXSPI_IPCR1_ISEQID(0) | FLEXSPI_IPCR1_IDATSZ(size)
-    writeFlashRegister(fl, 0xA4, size & 0xffff)
-    # IPCMD = 1
-    writeFlashRegister(fl, 0xB0, 1)
+    # upload the register writes together
+    with fl.batch() as batch:
+        # FLSHCR2 |= 0x80000000
+        writeFlashRegister(fl, FlexSPI.FLSHA1CR2, 0x80000000, True, batch)
+        # INTR |= 0x1e
+        writeFlashRegister(fl, FlexSPI.INTR, 0x1e, True, batch)
+        # IPCR0 = offset
+        writeFlashRegister(fl, FlexSPI.IPCR0, offset, batch=batch)
+        # IPRXFCR = 1
+        writeFlashRegister(fl, FlexSPI.IPRXFCR, 1, batch=batch)
+        # IPTXFCR = 1
+        writeFlashRegister(fl, FlexSPI.IPTXFCR, 1, batch=batch)
+        # seqId 0 == read/device_id depending on configuration block
+        # IPCR1 = FLEXSPI_IPCR1_ISEQID(0) | FLEXSPI_IPCR1_IDATSZ(size)
+        writeFlashRegister(fl, FlexSPI.IPCR1, size & 0xffff, batch=batch)
+        # IPCMD = 1
+        writeFlashRegister(fl, FlexSPI.IPCMD, 1, batch=batch)
     # ret = RFDR[0]
-    ret = fl.read32(0x402A8100)
+    ret = fl.flexspi.read(FlexSPI.RFDR)
     if ret == None:
         raise ReadFailedException("Failed to read RFDR")
     return ret
 
+def flashRead(fl, offset, size, sink=None):
+    # read through the AHB window, the flashloader streams the whole span in one command
+    try:
+        data = fl.read_memory(fl.flash_base + offset, size, sink)
+    except flashloader.CommandFailedError as e:
+        raise ReadFailedException(str(e.args[0]))
+
+    received = data if sink != None else len(data)
+    if received != size:
+        raise ReadFailedException(f'Short read, got {received} of {size} bytes')
+    return data
+
+def retryRead(fl, address, read):
+    """
+    Calls read until it succeeds, with an increasing delay in between.
+    Raises the last error once all retries failed.
+    """
+
+    delay = dumpRetryDelay
+    for attempt in range(dumpRetries + 1):
+        try:
+            return read()
+        except (ReadFailedException, hid.HIDTimeoutError) as e:
+            if attempt == dumpRetries:
+                print(f'\nFailed to read from 0x{address:08x} ({e}), giving up')
+                raise
+
+            print(f'\nFailed to read from 0x{address:08x} ({e}), trying again in {delay:.1f}s...')
+            # late frames of the failed read would end up in the next one otherwise
+            fl.drain(delay)
+            delay = min(delay * 2, dumpRetryMaxDelay)
+
 def detectFlashType(fl):
     # load the get_vendor_id configuration block
     fcb = utils.get_data_file('flashloader_fcb_get_vendor_id.bin')
@@ -142,14 +221,24 @@ def detectFlashType(fl):
 def setupFlash(fl, name):
     if name == 'Giga-16m':
         fl.set32(0x2000, 0xC0000206)
+        # the flashloader probes the geometry on its own with this option, these are only defaults
+        fl.flash_size = 0x1000000
+        fl.sector_size = 0x1000
+        fl.block_size = 0x10000
     elif name == 'Winbond-16m':
-        fcb = utils.get_data_file('flashloader_fcb_w25q128jw.bin')
-        fl.write_memory(0x2000, fcb)
+        data = utils.get_data_file('flashloader_fcb_w25q128jw.bin')
+        fl.write_memory(0x2000, data)
+        fcb = fcb_parser.FCB(data)
+        fl.flash_size = fcb.sflashA1Size
+        fl.sector_size = fcb.sectorSize
+        fl.block_size = fcb.blockSize
     else:
         print('unknown flash type ' + name)
         sys.exit(1)
 
     fl.configure_memory(9, 0x2000)
+    # prefer the geometry the flashloader detected over the defaults
+    fl.read_memory_attributes()
 
 class FirmwareBuildInfo:
     bootable = False
@@ -219,37 +308,216 @@ class FirmwareBuildInfo:
         # get partition info based on reset handler
         self.partition_info = FirmwareBuildInfo.Partition(self.reset_handler_address)
 
-def flashFirmware(dev):
-    if len(sys.argv) < 3:
-        print('Usage:\npython3 python3 stadiatool.py flash_firmware <firmware_signed.bin>')
-        sys.exit(1)
+    def to_metadata(self):
+        return {
+            'bootable': self.bootable,
+            'reset_handler_address': self.reset_handler_address,
+            'partition': {
+                'name': self.partition_info.name,
+                'offset': self.partition_info.offset,
+                'size': self.partition_info.size,
+                'slot': self.partition_info.slot,
+            },
+        }
+
+    @staticmethod
+    def from_metadata(metadata):
+        """Restores build info of an image which has already been validated"""
+        fw_info = FirmwareBuildInfo.__new__(FirmwareBuildInfo)
+        fw_info.bootable = metadata['bootable']
+        fw_info.reset_handler_address = metadata['reset_handler_address']
+        fw_info.partition_info = FirmwareBuildInfo.Partition(fw_info.reset_handler_address)
+        return fw_info
+
+def loadFirmware(path):
+    """
+    Loads a firmware image through the image cache.
+    Returns (digest, data, build info, CRC-32), images are only parsed and checksummed the first time they're seen.
+    """
+
+    global imageCache
+    with cacheLock:
+        if not imageCache:
+            imageCache = imagecache.ImageCache()
+
+    digest, fw = imageCache.load(path)
+    metadata = imageCache.get_metadata(digest)
+    if metadata and 'crc32' in metadata:
+        return digest, fw, FirmwareBuildInfo.from_metadata(metadata), metadata['crc32']
 
-    fw = utils.get_file(sys.argv[2])
     fw_info = FirmwareBuildInfo(fw)
 
+    metadata = fw_info.to_metadata()
+    metadata['size'] = len(fw)
+    metadata['crc32'] = zlib.crc32(fw)
+    imageCache.set_metadata(digest, metadata)
+
+    return digest, fw, fw_info, metadata['crc32']
+
+def diffFlash(fl, address, data, sector_size):
+    """
+    Compares data against the current flash contents at address.
+    Returns a list of sector aligned (start, end) ranges of data which differ.
+    """
+
+    ranges = []
+    pos = 0
+    while pos < len(data):
+        size = min(dumpChunkSize, len(data) - pos)
+        size += -size % sector_size
+        try:
+            cur = retryRead(fl, address + pos, lambda: flashRead(fl, address - fl.flash_base + pos, size))
+        except (ReadFailedException, hid.HIDTimeoutError):
+            sys.exit(1)
+
+        for sector in range(0, size, sector_size):
+            start = pos + sector
+            end = min(start + sector_size, len(data))
+            if start >= end:
+                break
+
+            # the tail of a partially used sector is erased as well
+            new = data[start:end] + b'\xff' * (sector_size - (end - start))
+            if cur[sector:sector+sector_size] == new:
+                continue
+
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+
+        print(f'\rComparing [0x{address + min(pos + size, len(data)):08x} / 0x{address + len(data):08x}]', end='')
+        pos += size
+    print('')
+
+    return ranges
+
+def programFlash(fl, address, data, delta=False):
+    if delta:
+        ranges = diffFlash(fl, address, data, fl.sector_size)
+        changed = sum([(end - start + fl.sector_size - 1) // fl.sector_size for start, end in ranges])
+        total = (len(data) + fl.sector_size - 1) // fl.sector_size
+        print(f'{changed} of {total} sectors differ')
+    else:
+        ranges = [(0, len(data))]
+
+    # erase and program window by window, if flashing is interrupted at most one window
+    # is left erased. windows are block aligned, so they don't split the erase plan's block erases
+    window = max(flashWindowSize // fl.block_size, 1) * fl.block_size
+    view = memoryview(data)
+    total = sum([end - start for start, end in ranges])
+    done = 0
+    for start, end in ranges:
+        pos = start
+        while pos < end:
+            window_end = min(end, ((address + pos) // window + 1) * window - address)
+
+            fl.flash_erase_region(address + pos, window_end - pos)
+            fl.write_memory(address + pos, view[pos:window_end])
+
+            done += window_end - pos
+            print(f'\rFlashing [0x{done:08x} / 0x{total:08x}]', end='')
+            pos = window_end
+    if total:
+        print('')
+
+def verifyFlash(fl, address, size, expected_crc):
+    crc = fl.crc32(address, size)
+    if crc == None:
+        print('Flashloader does not allow calling code, reading back to verify')
+        crc = 0
+        for chunk in fl.iter_memory(address, size):
+            crc = zlib.crc32(chunk, crc)
+
+    if crc != expected_crc:
+        print(f'Verification failed at 0x{address:08x}, CRC32 is 0x{crc:08x}, expected 0x{expected_crc:08x}')
+        sys.exit(1)
+
+    print(f'Verified 0x{address:08x} - 0x{address + size:08x} (CRC32 0x{crc:08x})')
+
+def formatVersion(version):
+    # e.g. 0x4b010500 is K1.5.0
+    return f'{chr(version >> 24)}{(version >> 16) & 0xff}.{(version >> 8) & 0xff}.{version & 0xff}'
+
+def openFlashloader(dev):
     fl = flashloader.Flashloader(dev)
 
+    properties = fl.discover()
+    version = properties.get(flashloader.Flashloader.Property_CurrentVersion)
+    if version:
+        print(f'Flashloader version {formatVersion(version)}, max packet size {fl.max_packet_size}')
+
+    # what was detected is remembered per unit, the port path could belong to another controller by now
+    unit_id = fl.unique_id()
+    profile = getDeviceProfiles().get_unit(unit_id) if unit_id else None
+    if profile and setupKnownFlash(fl, profile):
+        return fl
+
     print('Detecting MCU type...')
-    detectMCUType(fl)
+    mcu_type = detectMCUType(fl)
     print('Detecting Flash type...')
     flash_type = detectFlashType(fl)
     print('Setting up flash')
     setupFlash(fl, flash_type)
 
+    if unit_id:
+        getDeviceProfiles().update_unit(unit_id, mcu_type=mcu_type, flash_type=flash_type)
+    return fl
+
+def setupKnownFlash(fl, profile):
+    """
+    Sets up the flash of a controller from its profile, without detecting it.
+    Returns False if the controller doesn't match the profile.
+    """
+
+    if profile.get('flash_type') not in flashTypes.values():
+        return False
+
+    # cheap consistency checks, in case the profile is out of date
+    if fl.read32(0x400D8260) != profile.get('mcu_type'):
+        return False
+
+    print(f'Known controller, MCU: {mcuTypes.get(profile["mcu_type"])}, Flash: {profile["flash_type"]}')
+    print('Setting up flash')
+    setupFlash(fl, profile['flash_type'])
+
+    # with the right configuration the boot FCB is readable at the start of flash
+    try:
+        probe = fl.read32(fl.flash_base)
+    except flashloader.CommandFailedError:
+        probe = None
+
+    if probe != fcb_parser.FCB_TAG:
+        print('Flash does not match the known configuration, detecting it again')
+        return False
+
+    return True
+
+def flashFirmware(dev, path, delta=False, fl=None):
+    digest, fw, fw_info, fw_crc = loadFirmware(path)
+
+    if not fl:
+        fl = openFlashloader(dev)
+
     print('Clearing GPR flags')
-    fl.set32(0x400F8030, 0) # GPR 4
-    fl.set32(0x400F8034, 0) # GPR 5
-    fl.set32(0x400F8038, 0) # GPR 6
+    with fl.batch() as batch:
+        batch.set32(0x400F8030, 0) # GPR 4
+        batch.set32(0x400F8034, 0) # GPR 5
+        batch.set32(0x400F8038, 0) # GPR 6
 
     if fw_info.bootable:
         print('Extracting IVT and flashing')
         ivt = fw[fw_info.ivt_offset:fw_info.ivt_offset+fw_info.ivt_size]
-        fl.flash_erase_region(0x60001000, len(ivt))
-        fl.write_memory(0x60001000, ivt)
+        programFlash(fl, 0x60001000, ivt, delta)
+        verifyFlash(fl, 0x60001000, len(ivt), zlib.crc32(ivt))
 
     print(f'Flashing to {fw_info.partition_info.name} at 0x{fw_info.partition_info.offset:08x}...')
-    fl.flash_erase_region(fw_info.partition_info.offset, len(fw))
-    fl.write_memory(fw_info.partition_info.offset, fw)
+    start = time.monotonic()
+    programFlash(fl, fw_info.partition_info.offset, fw, delta)
+    print('Flashed ' + utils.format_throughput(len(fw), time.monotonic() - start))
+
+    print('Verifying...')
+    verifyFlash(fl, fw_info.partition_info.offset, len(fw), fw_crc)
 
     # set GPR 6 to slot
     if fw_info.partition_info.slot == 1:
@@ -257,72 +525,184 @@ def flashFirmware(dev):
     elif fw_info.partition_info.slot == 2:
         fl.set32(0x400F8038, 2)
 
+    getDeviceProfiles().update(getDevicePath(dev), last_image=digest)
+
     print('Resetting device')
     fl.reset()
 
     print('Done!')
 
-def dumpFlash(dev):
-    if len(sys.argv) < 5:
-        print('Usage:\npython3 stadiatool.py dump <start> <end> <dump.bin>')
+def readDumpChunk(fl, address, size, mode, buffer):
+    if mode == 'ahb':
+        # straight into the output file
+        flashRead(fl, address, size, buffer)
+        return
+
+    # one IP command per word, slow but doesn't depend on the AHB mapping
+    data = b''.join([struct.pack('<I', flashRead32(fl, pos, 4)) for pos in range(address, address + size, 4)])
+    buffer[:] = data[:size]
+
+def dumpFlash(dev, offset, end, path, mode='ahb', fl=None):
+    if end <= offset:
+        print('End address must be after the start address')
         sys.exit(1)
 
-    offset = int(sys.argv[2], 0)
-    end = int(sys.argv[3], 0)
+    if not fl:
+        fl = openFlashloader(dev)
 
-    fl = flashloader.Flashloader(dev)
+    chunk_size = dumpChunkSize if mode == 'ahb' else ipDumpChunkSize
 
-    print('Detecting MCU type...')
-    detectMCUType(fl)
-    print('Detecting Flash type...')
-    flash_type = detectFlashType(fl)
-    print('Setting up flash')
-    setupFlash(fl, flash_type)
+    with dumpfile.DumpFile(path, offset, end, chunk_size) as f:
+        chunks = f.missing_chunks()
+        if f.resumed:
+            print(f'Resuming dump, {f.num_chunks - len(chunks)} of {f.num_chunks} chunks already read')
 
-    with open(sys.argv[4], 'wb') as f:
-        for i in range(offset // 4, end // 4):
-            while True:
-                try:
-                    flash_data = struct.pack('<I', flashRead32(fl, i * 4, 4))
-                except ReadFailedException as e:
-                    print(f'\nFailed to read from 0x{i * 4:08x} ({e}), trying again...')
-                    continue
-                print(f'\rReading [0x{i * 4:08x} / 0x{end:08x}]', end='')
-                f.write(flash_data)
-                break
+        for index, address, size in chunks:
+            def readChunk():
+                with f.chunk_buffer(index) as buffer:
+                    readDumpChunk(fl, address, size, mode, buffer)
+
+            try:
+                retryRead(fl, address, readChunk)
+            except (ReadFailedException, hid.HIDTimeoutError):
+                print('Run the same dump again to resume it')
+                sys.exit(1)
+
+            f.mark_done(index)
+            print(f'\rReading [0x{address + size:08x} / 0x{end:08x}]', end='')
         print('')
 
     print('Done!')
 
-def reset(dev):
-    fl = flashloader.Flashloader(dev)
+def reset(dev, fl=None):
+    if not fl:
+        fl = flashloader.Flashloader(dev)
     fl.reset()
 
-if len(sys.argv) < 2:
-    print(f'Usage: {sys.argv[0]} <info/flashloader/flash_firmware/dump/reset>')
-    sys.exit(1)
+def isStadiaController(dev):
+    return any([True for f in deviceFilters if f['vendorId'] == dev.idVendor and f['productId'] == dev.idProduct])
 
-dev = usb.core.find(custom_match=lambda dev: any([True for f in deviceFilters if f['vendorId'] == dev.idVendor and f['productId'] == dev.idProduct]))
-if not dev:
-    print('Could not find stadia controller')
-    sys.exit(1)
+def getDevicePath(dev):
+    """Returns bus and port path of a device, this stays the same when the device re-enumerates"""
+    ports = dev.port_numbers or []
+    return f'{dev.bus}-' + '.'.join([str(p) for p in ports])
 
-print(f'Found: {dev.idVendor:04x}:{dev.idProduct:04x} ({dev.manufacturer} {dev.product})')
-
-# detach kernel driver if active
-if dev.is_kernel_driver_active(0):
-    dev.detach_kernel_driver(0)
-
-if sys.argv[1] == 'info':
-    printInfo(dev)
-elif sys.argv[1] == 'flashloader':
-    loadFlashloader(dev)
-elif sys.argv[1] == 'flash_firmware':
-    flashFirmware(dev)
-elif sys.argv[1] == 'dump':
-    dumpFlash(dev)
-elif sys.argv[1] == 'reset':
-    reset(dev)
-else:
-    print(f'Unknown arg "{sys.argv[1]}"')
+def detachKernelDriver(dev):
+    # detach kernel driver if active
+    if dev.is_kernel_driver_active(0):
+        dev.detach_kernel_driver(0)
+
+def openDevice(dev):
+    print(f'Found: {dev.idVendor:04x}:{dev.idProduct:04x} ({dev.manufacturer} {dev.product})')
+
+    detachKernelDriver(dev)
+
+def printUsage():
+    print(f'Usage: {sys.argv[0]} [--trace <trace.json>] [--record <file> | --replay <file> [--fast]] <info/flashloader/flash_firmware/dump/reset/station/daemon/remote/telemetry>')
     sys.exit(1)
+
+def takeOption(name):
+    """Removes an option and its value from the arguments, returns the value or None if it isn't given"""
+    if name not in sys.argv:
+        return None
+
+    i = sys.argv.index(name)
+    if i + 1 >= len(sys.argv):
+        printUsage()
+
+    value = sys.argv[i + 1]
+    del sys.argv[i:i + 2]
+    return value
+
+def main():
+    # record a trace of every transfer
+    trace_path = takeOption('--trace')
+    if trace_path:
+        hid.HID.tracer = usbtrace.Tracer()
+
+    # record every usb transfer, or replay a recording without devices
+    record_path = takeOption('--record')
+    replay_path = takeOption('--replay')
+    if record_path and replay_path:
+        printUsage()
+
+    if record_path or replay_path:
+        # saved profiles would change which transfers are made, so both start without them.
+        # set through the stadiatool module, which station, daemon and telemetry use
+        import stadiatool
+        stadiatool.setDeviceProfiles(profiles.ProfileCache(None))
+
+    if record_path:
+        transport.backend = transport.RecordingBackend(transport.backend, record_path)
+    elif replay_path:
+        realtime = '--fast' not in sys.argv
+        if not realtime:
+            sys.argv.remove('--fast')
+        transport.backend = transport.ReplayBackend(replay_path, realtime)
+
+    try:
+        runCommand()
+    finally:
+        transport.backend.close()
+        if trace_path:
+            hid.HID.tracer.export_chrome(trace_path)
+            print(f'Wrote trace to {trace_path}')
+
+def runCommand():
+    if len(sys.argv) < 2:
+        printUsage()
+
+    if sys.argv[1] == 'station':
+        import station
+        station.main(sys.argv[2:])
+        return
+
+    if sys.argv[1] == 'telemetry':
+        import telemetry
+        telemetry.main(sys.argv[2:])
+        return
+
+    if sys.argv[1] in ['daemon', 'remote']:
+        import daemon
+        daemon.main(sys.argv[1:])
+        return
+
+    dev = transport.find(custom_match=isStadiaController)
+    if not dev:
+        print('Could not find stadia controller')
+        sys.exit(1)
+
+    openDevice(dev)
+
+    if sys.argv[1] == 'info':
+        printInfo(dev)
+    elif sys.argv[1] == 'flashloader':
+        loadFlashloader(dev, sys.argv[2] if len(sys.argv) > 2 else None)
+    elif sys.argv[1] == 'flash_firmware':
+        if len(sys.argv) < 3:
+            print('Usage:\npython3 stadiatool.py flash_firmware <firmware_signed.bin> [--delta]')
+            sys.exit(1)
+
+        # only erase and write sectors which differ from what's currently in flash
+        delta = '--delta' in sys.argv[3:]
+
+        flashFirmware(dev, sys.argv[2], delta)
+    elif sys.argv[1] == 'dump':
+        if len(sys.argv) < 5:
+            print('Usage:\npython3 stadiatool.py dump <start> <end> <dump.bin> [ahb/ip]')
+            sys.exit(1)
+
+        mode = sys.argv[5] if len(sys.argv) > 5 else 'ahb'
+        if mode not in ['ahb', 'ip']:
+            print(f'Unknown dump mode "{mode}"')
+            sys.exit(1)
+
+        dumpFlash(dev, int(sys.argv[2], 0), int(sys.argv[3], 0), sys.argv[4], mode)
+    elif sys.argv[1] == 'reset':
+        reset(dev)
+    else:
+        print(f'Unknown arg "{sys.argv[1]}"')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""
+Station mode, runs info, flashloader and flash_firmware on every attached
+controller in parallel.
+
+Controllers are tracked by their USB port path, since a controller
+re-enumerates with a different VID/PID when it changes modes. Each stage is
+started as soon as the tracker sees the controller in the matching mode.
+"""
+
+import usb.core
+import stadiatool
+import tracker
+import transport
+import concurrent.futures
+import threading
+import time
+import sys
+
+# seconds to wait for a controller to show up in its next mode
+MODE_TIMEOUT = 120
+# seconds between timeout checks
+POLL_INTERVAL = .25
+# default limit of controllers handled at once
+MAX_WORKERS = 64
+
+MODE_OEM            = (0x18d1, 0x9400)
+MODE_BOOTLOADER     = (0x18d1, 0x946b)
+MODE_SDP            = (0x1fc9, 0x0135)
+MODE_FLASHLOADER    = (0x15a2, 0x0073)
+
+class StationOutput:
+    """
+    stdout replacement which prefixes every line with the port path of the
+    controller the current worker thread is handling.
+    Progress updates using carriage returns are collapsed to their last state.
+    """
+
+    stream = None
+    local = None
+    lock = None
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def set_prefix(self, prefix):
+        self.local.prefix = prefix
+        self.local.line = ''
+
+    def write(self, text):
+        prefix = getattr(self.local, 'prefix', None)
+        if prefix == None:
+            return self.stream.write(text)
+
+        lines = (self.local.line + text).split('\n')
+        self.local.line = lines.pop()
+        with self.lock:
+            for line in lines:
+                line = line.split('\r')[-1]
+                if line:
+                    self.stream.write(f'[{prefix}] {line}\n')
+
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+class StationJob:
+    path = ''
+    serial = ''
+    mode = None
+    status = 'pending'
+    error = ''
+    timings = None
+    start = 0
+
+    # a stage is running for this controller
+    busy = False
+    # the controller re-enumerated while a stage was running
+    pending = None
+    # the next mode has to show up before this
+    deadline = 0
+    # the controller is flashed, the next re-enumeration is it booting the new firmware
+    awaiting_reset = False
+
+    def __init__(self, dev):
+        self.path = stadiatool.getDevicePath(dev)
+        self.mode = (dev.idVendor, dev.idProduct)
+        self.serial = getSerialNumber(dev)
+        self.timings = {}
+        self.start = time.monotonic()
+
+    def finished(self):
+        return self.status in ['done', 'failed', 'skipped']
+
+def getSerialNumber(dev):
+    try:
+        return dev.serial_number or ''
+    except (ValueError, usb.core.USBError):
+        return ''
+
+def findControllers():
+    return list(transport.find(find_all=True, custom_match=stadiatool.isStadiaController))
+
+def runStage(job, name, func, *args):
+    job.status = name
+    start = time.monotonic()
+    func(*args)
+    job.timings[name] = time.monotonic() - start
+
+class Station:
+    """
+    Moves every controller to its next stage as soon as it shows up in a new mode.
+    Without watch, only the controllers attached at startup are handled.
+    """
+
+    fw_path = ''
+    delta = False
+    watch = False
+    accepting = True
+
+    # port path -> current job
+    jobs = None
+    history = None
+    pool = None
+    cond = None
+
+    def __init__(self, fw_path, delta, jobs_max, watch):
+        self.fw_path = fw_path
+        self.delta = delta
+        self.watch = watch
+        self.jobs = {}
+        self.history = []
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs_max or MAX_WORKERS)
+        self.cond = threading.Condition()
+
+    def device_changed(self, path, dev):
+        with self.cond:
+            self.handle(path, dev)
+
+    def handle(self, path, dev):
+        job = self.jobs.get(path)
+        if job and job.busy:
+            if dev:
+                job.pending = dev
+            return
+
+        if job and job.finished():
+            if job.awaiting_reset:
+                job.awaiting_reset = dev == None
+                return
+
+            # the controller was unplugged, the port is free for the next one
+            del self.jobs[path]
+            job = None
+
+        if not dev:
+            return
+
+        if not job:
+            if not self.accepting:
+                return
+
+            job = StationJob(dev)
+            self.jobs[path] = job
+            self.history.append(job)
+
+        job.busy = True
+        self.pool.submit(Station.run_stage, self, job, dev)
+
+    def run_stage(self, job, dev):
+        sys.stdout.set_prefix(job.path)
+        job.mode = (dev.idVendor, dev.idProduct)
+
+        try:
+            if job.mode == MODE_BOOTLOADER:
+                job.status = 'skipped'
+                job.error = 'controller is in bootloader mode'
+            elif job.mode == MODE_OEM:
+                stadiatool.openDevice(dev)
+                runStage(job, 'info', stadiatool.printInfo, dev)
+                print('Waiting for SDP mode...')
+                job.status = 'waiting'
+            elif job.mode == MODE_SDP:
+                stadiatool.openDevice(dev)
+                runStage(job, 'flashloader', stadiatool.loadFlashloader, dev)
+                job.status = 'waiting'
+            elif job.mode == MODE_FLASHLOADER:
+                stadiatool.openDevice(dev)
+                runStage(job, 'flash_firmware', stadiatool.flashFirmware, dev, self.fw_path, self.delta)
+                job.status = 'done'
+                job.awaiting_reset = True
+        except SystemExit:
+            job.error = 'aborted during ' + job.status
+            job.status = 'failed'
+        except Exception as e:
+            job.error = f'{type(e).__name__}: {e}'
+            job.status = 'failed'
+
+        with self.cond:
+            job.busy = False
+            job.deadline = time.monotonic() + MODE_TIMEOUT
+            if job.finished():
+                job.timings['total'] = time.monotonic() - job.start
+
+            dev, job.pending = job.pending, None
+            if dev:
+                self.handle(job.path, dev)
+
+            self.cond.notify_all()
+
+    def check_timeouts(self):
+        now = time.monotonic()
+        for job in self.jobs.values():
+            if job.finished() or job.busy or now < job.deadline:
+                continue
+
+            job.error = 'controller did not enter SDP mode' if job.mode == MODE_OEM else 'flashloader did not enumerate'
+            job.status = 'failed'
+            job.timings['total'] = now - job.start
+
+    def run(self, device_tracker):
+        device_tracker.add_callback(self.device_changed)
+        # picks up the controllers which are already attached
+        device_tracker.start()
+
+        with self.cond:
+            self.accepting = self.watch
+            if not self.watch:
+                print(f'Found {len(self.jobs)} controllers')
+            else:
+                print('Waiting for controllers, press Ctrl-C to stop')
+
+        try:
+            with self.cond:
+                while self.watch or not all([job.finished() for job in self.jobs.values()]):
+                    self.cond.wait(POLL_INTERVAL)
+                    self.check_timeouts()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            device_tracker.stop()
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+        return self.history
+
+def printSummary(jobs):
+    print('')
+    print(f'{"path":<12} {"serial":<20} {"status":<8} {"info":>7} {"loader":>7} {"flash":>7} {"total":>7}')
+    for job in jobs:
+        times = [job.timings.get(stage) for stage in ['info', 'flashloader', 'flash_firmware', 'total']]
+        times = ['{:>6.1f}s'.format(t) if t != None else '{:>7}'.format('-') for t in times]
+        print(f'{job.path:<12} {job.serial:<20} {job.status:<8} ' + ' '.join(times))
+        if job.error:
+            print(f'    {job.error}')
+
+def main(args):
+    if len(args) < 1:
+        print('Usage:\npython3 stadiatool.py station <firmware_signed.bin> [--delta] [--jobs <n>] [--watch]')
+        sys.exit(1)
+
+    fw_path = args[0]
+    delta = '--delta' in args[1:]
+    # keep running and handle every controller that gets plugged in
+    watch = '--watch' in args[1:]
+    jobs_max = None
+    if '--jobs' in args[1:]:
+        jobs_max = int(args[args.index('--jobs') + 1])
+
+    if not findControllers() and not watch:
+        print('Could not find any stadia controllers')
+        sys.exit(1)
+
+    _station = Station(fw_path, delta, jobs_max, watch)
+
+    sys.stdout = StationOutput(sys.stdout)
+    try:
+        jobs = _station.run(tracker.DeviceTracker())
+    finally:
+        sys.stdout = sys.stdout.stream
+
+    printSummary(jobs)
+
+    if any([job.status != 'done' for job in jobs]):
+        sys.exit(1)
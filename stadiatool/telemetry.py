@@ -0,0 +1,198 @@
+"""
+Telemetry mode, reads firmware version and battery level of every attached
+controller in OEM mode and prints them as JSON lines.
+
+Requests are pipelined across controllers: battery measurements are started
+on all of them first, firmware versions are read while they're measuring,
+and the results are collected as they become ready. A round takes about as
+long as a single measurement, no matter how many controllers are attached.
+Values are cached for a while, so frequent polling doesn't keep every
+controller busy.
+"""
+
+import usb.core
+import stadiatool
+import station
+import oem
+import errno
+import json
+import sys
+import time
+
+# seconds until a cached value is read again
+FIRMWARE_TTL = 300
+BATTERY_TTL = 10
+
+# seconds between reads of a measurement which isn't done yet
+BATTERY_POLL_INTERVAL = .005
+# seconds until a battery measurement is given up on
+BATTERY_TIMEOUT = 1
+
+class TelemetryCache:
+    """Values per controller, a re-enumerated controller starts with an empty entry"""
+
+    entries = None
+
+    def __init__(self):
+        self.entries = {}
+
+    def key(self, dev):
+        return (stadiatool.getDevicePath(dev), dev.address)
+
+    def get(self, dev, name, ttl):
+        value, timestamp = self.entries.get(self.key(dev), {}).get(name, (None, 0))
+        if value == None or time.monotonic() - timestamp > ttl:
+            return None
+        return value
+
+    def set(self, dev, name, value):
+        self.entries.setdefault(self.key(dev), {})[name] = (value, time.monotonic())
+
+class TelemetryRequest:
+    dev = None
+    oem = None
+    record = None
+    # waiting for the battery measurement
+    pending = False
+    # when the measurement should be done
+    ready = 0
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.record = {
+            'time': time.time(),
+            'path': stadiatool.getDevicePath(dev),
+            'serial': station.getSerialNumber(dev),
+            'cached': [],
+        }
+
+def emit(record):
+    print(json.dumps(record), flush=True)
+
+def pollControllers(devices, cache, battery_ttl=BATTERY_TTL, firmware_ttl=FIRMWARE_TTL, timeout=BATTERY_TIMEOUT):
+    """Reads the telemetry of every controller, records are printed as soon as they're complete"""
+
+    requests = [TelemetryRequest(dev) for dev in devices]
+
+    # start the battery measurements first, they all run at the same time
+    for r in requests:
+        # control requests to the interface fail while the kernel driver holds it
+        try:
+            stadiatool.detachKernelDriver(r.dev)
+        except usb.core.USBError as e:
+            r.record['error'] = str(e)
+            continue
+
+        battery = cache.get(r.dev, 'battery', battery_ttl)
+        if battery != None:
+            r.record['battery'] = battery
+            r.record['cached'].append('battery')
+            continue
+
+        try:
+            r.oem = oem.OEM(r.dev)
+            r.oem.request_battery_percentage()
+            r.ready = time.monotonic() + oem.BATTERY_MEASURE_TIME
+            r.pending = True
+        except (oem.OEMError, usb.core.USBError) as e:
+            r.record['error'] = str(e)
+
+    # read the firmware versions while measuring
+    for r in requests:
+        if 'error' in r.record:
+            continue
+
+        firmware = cache.get(r.dev, 'firmware', firmware_ttl)
+        if firmware != None:
+            r.record['cached'].append('firmware')
+        else:
+            try:
+                firmware = (r.oem or oem.OEM(r.dev)).get_firmware_version()
+                cache.set(r.dev, 'firmware', firmware)
+            except (oem.OEMError, usb.core.USBError) as e:
+                r.record['error'] = str(e)
+                r.pending = False
+                continue
+
+        if firmware != None:
+            r.record['firmware'] = firmware
+            r.record['firmware_name'] = stadiatool.getFirmwareName(firmware)
+
+    for r in requests:
+        if not r.pending:
+            emit(r.record)
+
+    # collect the measurements once they're done, a single read is only made after the same delay
+    deadline = time.monotonic() + timeout
+    pending = [r for r in requests if r.pending]
+    while pending:
+        for r in pending:
+            if time.monotonic() < r.ready:
+                continue
+
+            try:
+                battery = r.oem.read_battery_percentage()
+            except usb.core.USBError as e:
+                # some controllers stall the request while they're still measuring
+                if e.errno == errno.EPIPE and time.monotonic() < deadline:
+                    continue
+
+                r.record['error'] = str(e)
+                r.pending = False
+                emit(r.record)
+                continue
+
+            if battery != None:
+                cache.set(r.dev, 'battery', battery)
+            r.record['battery'] = battery
+            r.pending = False
+            emit(r.record)
+
+        pending = [r for r in pending if r.pending]
+        if pending and time.monotonic() >= deadline:
+            for r in pending:
+                r.record['error'] = 'battery measurement timed out'
+                emit(r.record)
+            break
+
+        if pending:
+            time.sleep(max(BATTERY_POLL_INTERVAL, min([r.ready for r in pending]) - time.monotonic()))
+
+    return [r.record for r in requests]
+
+def printUsage():
+    print('Usage:\npython3 stadiatool.py telemetry [--interval <seconds>] [--ttl <seconds>]')
+    sys.exit(1)
+
+def getSeconds(args, name, default):
+    """Returns the number of seconds given for an option, prints usage if it has no valid value"""
+    if name not in args:
+        return default
+
+    i = args.index(name)
+    try:
+        return float(args[i + 1])
+    except (IndexError, ValueError):
+        printUsage()
+
+def main(args):
+    interval = getSeconds(args, '--interval', None)
+    battery_ttl = getSeconds(args, '--ttl', BATTERY_TTL)
+
+    cache = TelemetryCache()
+    try:
+        while True:
+            start = time.monotonic()
+            devices = [dev for dev in station.findControllers() if (dev.idVendor, dev.idProduct) == station.MODE_OEM]
+            pollControllers(devices, cache, battery_ttl)
+
+            # a single round without an interval
+            if interval == None:
+                if not devices:
+                    print('Could not find any stadia controllers in OEM mode', file=sys.stderr)
+                    sys.exit(1)
+                return
+
+            time.sleep(max(0, interval - (time.monotonic() - start)))
+    except KeyboardInterrupt:
+        pass
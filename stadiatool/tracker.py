@@ -0,0 +1,100 @@
+"""
+Follows controllers across re-enumeration.
+
+pyusb has no hotplug support, so a single background thread scans the bus and
+reports every controller showing up, changing modes or going away, keyed by
+its USB port path. Waiting for a controller wakes up as soon as the scan sees
+it, instead of every waiter scanning the bus on its own.
+"""
+
+import stadiatool
+import transport
+import threading
+import time
+
+# seconds between bus scans
+POLL_INTERVAL = .1
+
+def deviceKey(dev):
+    """Changes whenever the device re-enumerates"""
+    return (dev.idVendor, dev.idProduct, dev.address)
+
+class DeviceTracker:
+    poll_interval = POLL_INTERVAL
+
+    # port path -> attached device
+    devices = None
+    callbacks = None
+    cond = None
+    thread = None
+    running = False
+
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.devices = {}
+        self.callbacks = []
+        self.cond = threading.Condition()
+
+    def add_callback(self, callback):
+        """callback(path, dev) is called from the tracker thread, dev is None if the controller went away"""
+        self.callbacks.append(callback)
+
+    def start(self):
+        self.scan()
+        self.running = True
+        self.thread = threading.Thread(daemon=True, target=DeviceTracker.run, args=(self,))
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while self.running:
+            time.sleep(self.poll_interval)
+            self.scan()
+
+    def scan(self):
+        found = {}
+        for dev in transport.find(find_all=True, custom_match=stadiatool.isStadiaController):
+            found[stadiatool.getDevicePath(dev)] = dev
+
+        changes = []
+        with self.cond:
+            for path, dev in list(self.devices.items()):
+                if path not in found:
+                    del self.devices[path]
+                    changes.append((path, None))
+
+            for path, dev in found.items():
+                known = self.devices.get(path)
+                if known and deviceKey(known) == deviceKey(dev):
+                    continue
+
+                # keep the first device object, so users can tell if it re-enumerated
+                self.devices[path] = dev
+                changes.append((path, dev))
+
+            if changes:
+                self.cond.notify_all()
+
+        for path, dev in changes:
+            for callback in self.callbacks:
+                callback(path, dev)
+
+    def get_devices(self):
+        with self.cond:
+            return dict(self.devices)
+
+    def wait_for(self, path, mode, timeout):
+        """Waits for the controller at path to show up with the given (vendor, product) id"""
+
+        def match():
+            dev = self.devices.get(path)
+            if dev and (dev.idVendor, dev.idProduct) == mode:
+                return dev
+            return None
+
+        with self.cond:
+            return self.cond.wait_for(match, timeout)
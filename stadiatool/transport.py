@@ -0,0 +1,444 @@
+"""
+Device selection and USB transfers, with recording and replay.
+
+Everything finds controllers through transport.find(), which goes to the
+active backend: pyusb by default, the simulator's bus, a recording wrapper
+around another backend, or the replay of a recorded trace.
+
+A trace holds every find, control transfer, endpoint read and write with its
+result and timing in a compact binary format. Replaying it needs no USB
+devices: transfers are checked against the recording in order and answered
+with the recorded results, either at the original speed or as fast as
+possible. Changes which alter what goes over the wire fail with a
+ReplayMismatchError.
+
+Finds are matched by their arguments. How often a find is repeated depends
+on timing, so a replayed find gets the latest recorded result for the same
+arguments which was made after no more transfers than were replayed so far.
+
+Trace format: b'STRC', u16 version, then records of
+(u8 op, u16 device id, f64 seconds since start, u32 payload size) + payload.
+"""
+
+import usb.core, usb.util
+import array
+import collections
+import errno
+import json
+import struct
+import threading
+import time
+
+TRACE_MAGIC = b'STRC'
+TRACE_VERSION = 2
+
+FILE_HEADER = struct.Struct('<4sH')
+RECORD_HEADER = struct.Struct('<BHdI')
+
+OP_DEVICE = 1   # json metadata of a device, written when it's first found
+OP_FIND = 2     # out transfers before it, arguments + u16 ids of the found devices
+OP_ATTR = 3     # json string descriptor or its error
+OP_CONFIG = 4   # json layout of the active configuration
+OP_WRITE = 5    # endpoint, status + data
+OP_READ = 6     # endpoint, status, out transfers before it + data
+OP_CTRL = 7     # request, status, out data size + out data + in data
+
+FIND = struct.Struct('<IH')
+WRITE = struct.Struct('<Bi')
+READ = struct.Struct('<BiI')
+CTRL = struct.Struct('<BBHHHiI')
+
+# attributes which are plain values of the device descriptor and its location
+DEVICE_ATTRIBUTES = ['idVendor', 'idProduct', 'bcdDevice', 'bus', 'address', 'port_numbers']
+# attributes which are read from the device when they're accessed
+STRING_ATTRIBUTES = ['serial_number', 'manufacturer', 'product']
+
+class ReplayMismatchError(Exception):
+    """A transfer doesn't match the recorded session"""
+
+def findKey(find_all, custom_match, args):
+    """Identifies the arguments of a find, custom_match by its function name"""
+    return json.dumps([find_all, getattr(custom_match, '__qualname__', None), args], sort_keys=True)
+
+def errorStatus(e):
+    return -(e.errno or errno.EIO)
+
+def raiseStatus(status):
+    if status == -errno.ETIMEDOUT:
+        raise usb.core.USBTimeoutError('Operation timed out', None, errno.ETIMEDOUT)
+    raise usb.core.USBError(f'Recorded error {-status}', None, -status)
+
+class UsbBackend:
+    def find(self, find_all=False, custom_match=None, **args):
+        return usb.core.find(find_all=find_all, custom_match=custom_match, **args)
+
+    def close(self):
+        pass
+
+backend = UsbBackend()
+
+def find(find_all=False, custom_match=None, **args):
+    """Same as usb.core.find, but on the active backend"""
+    return backend.find(find_all=find_all, custom_match=custom_match, **args)
+
+# recording
+
+class RecordingDevice:
+    """Passes everything through to a device and records its transfers"""
+
+    def __init__(self, dev, recorder, device_id):
+        self._dev = dev
+        self._recorder = recorder
+        self._id = device_id
+
+    def __getattr__(self, name):
+        if name not in STRING_ATTRIBUTES:
+            return getattr(self._dev, name)
+
+        try:
+            value = getattr(self._dev, name)
+        except (ValueError, usb.core.USBError) as e:
+            self._recorder.record_json(OP_ATTR, self._id, {'name': name, 'error': str(e)})
+            raise
+
+        self._recorder.record_json(OP_ATTR, self._id, {'name': name, 'value': value})
+        return value
+
+    def get_active_configuration(self):
+        configuration = self._dev.get_active_configuration()
+        self._recorder.record_json(OP_CONFIG, self._id, [{
+            'bInterfaceNumber': interface.bInterfaceNumber,
+            'bInterfaceClass': interface.bInterfaceClass,
+            'endpoints': [[e.bEndpointAddress, e.bmAttributes, e.wMaxPacketSize] for e in interface],
+        } for interface in configuration])
+        return configuration
+
+    def write(self, endpoint, data, timeout=None):
+        data = bytes(data)
+        status = -errno.EIO
+        try:
+            status = self._dev.write(endpoint, data, timeout)
+            return status
+        except usb.core.USBError as e:
+            status = errorStatus(e)
+            raise
+        finally:
+            self._recorder.record(OP_WRITE, self._id, WRITE.pack(endpoint, status) + data)
+            self._recorder.count_out(self._id)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        data = b''
+        status = -errno.EIO
+        try:
+            report = self._dev.read(endpoint, size_or_buffer, timeout)
+            data = bytes(report)
+            status = len(data)
+            return report
+        except usb.core.USBError as e:
+            status = errorStatus(e)
+            raise
+        finally:
+            self._recorder.record(OP_READ, self._id, READ.pack(endpoint, status, self._recorder.out_count(self._id)) + data)
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        out_data = b''
+        in_data = b''
+        length = 0
+        status = -errno.EIO
+        if bmRequestType & usb.util.CTRL_IN:
+            length = data_or_wLength or 0
+        else:
+            out_data = bytes(data_or_wLength or b'')
+
+        try:
+            result = self._dev.ctrl_transfer(bmRequestType, bRequest, wValue, wIndex, data_or_wLength, timeout)
+            if bmRequestType & usb.util.CTRL_IN:
+                in_data = bytes(result)
+                status = len(in_data)
+            else:
+                status = result
+            return result
+        except usb.core.USBError as e:
+            status = errorStatus(e)
+            raise
+        finally:
+            self._recorder.record(OP_CTRL, self._id,
+                CTRL.pack(bmRequestType, bRequest, wValue, wIndex, length, status, len(out_data)) + out_data + in_data)
+            self._recorder.count_out(self._id)
+
+class RecordingBackend:
+    """Records everything going through another backend into a trace file"""
+
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.file = open(path, 'wb')
+        self.file.write(FILE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION))
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        # (bus, address) -> device id, a device gets a new id whenever it re-enumerates
+        self.ids = {}
+        self.out_counts = collections.Counter()
+        self.out_total = 0
+
+    def record(self, op, device_id, payload):
+        with self.lock:
+            self.file.write(RECORD_HEADER.pack(op, device_id, time.monotonic() - self.start, len(payload)) + payload)
+
+    def record_json(self, op, device_id, value):
+        self.record(op, device_id, json.dumps(value).encode())
+
+    def count_out(self, device_id):
+        with self.lock:
+            self.out_counts[device_id] += 1
+            self.out_total += 1
+
+    def out_count(self, device_id):
+        with self.lock:
+            return self.out_counts[device_id]
+
+    def wrap(self, dev):
+        key = (dev.bus, dev.address, dev.idVendor, dev.idProduct)
+        with self.lock:
+            device_id = self.ids.get(key)
+            known = device_id != None
+            if not known:
+                device_id = len(self.ids) + 1
+                self.ids[key] = device_id
+
+        if not known:
+            metadata = {name: getattr(dev, name, None) for name in DEVICE_ATTRIBUTES}
+            metadata['port_numbers'] = list(metadata['port_numbers'] or [])
+            self.record_json(OP_DEVICE, device_id, metadata)
+
+        return RecordingDevice(dev, self, device_id)
+
+    def find(self, find_all=False, custom_match=None, **args):
+        found = self.inner.find(find_all=True, custom_match=custom_match, **args)
+        devices = [self.wrap(dev) for dev in found]
+        key = findKey(find_all, custom_match, args).encode()
+        with self.lock:
+            after = self.out_total
+        self.record(OP_FIND, 0, FIND.pack(after, len(key)) + key + struct.pack(f'<{len(devices)}H', *[dev._id for dev in devices]))
+
+        if find_all:
+            return iter(devices)
+        return devices[0] if devices else None
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# replay
+
+class ReplayEndpoint:
+    def __init__(self, address, attributes, max_packet_size):
+        self.bEndpointAddress = address
+        self.bmAttributes = attributes
+        self.wMaxPacketSize = max_packet_size
+
+class ReplayInterface:
+    def __init__(self, interface):
+        self.bInterfaceNumber = interface['bInterfaceNumber']
+        self.bInterfaceClass = interface['bInterfaceClass']
+        self.endpoints = [ReplayEndpoint(*e) for e in interface['endpoints']]
+
+    def __iter__(self):
+        return iter(self.endpoints)
+
+class ReplayConfiguration:
+    def __init__(self, interfaces):
+        self.interfaces = [ReplayInterface(i) for i in interfaces]
+
+    def __iter__(self):
+        return iter(self.interfaces)
+
+class ReplayDevice:
+    """Stands in for a recorded device, answers its transfers from the trace"""
+
+    def __init__(self, backend, device_id, metadata):
+        self._backend = backend
+        self._id = device_id
+        for name in DEVICE_ATTRIBUTES:
+            setattr(self, name, metadata.get(name))
+        self.port_numbers = tuple(self.port_numbers)
+
+    def __getattr__(self, name):
+        if name not in STRING_ATTRIBUTES:
+            raise AttributeError(name)
+
+        attribute = self._backend.attributes[self._id].get(name)
+        if not attribute or 'error' in attribute:
+            raise ValueError(attribute['error'] if attribute else f'{name} was not recorded')
+        return attribute['value']
+
+    def set_configuration(self, configuration=None):
+        pass
+
+    def get_active_configuration(self):
+        configuration = self._backend.configurations.get(self._id)
+        if configuration == None:
+            raise usb.core.USBError('Configuration was not recorded', None, errno.EIO)
+        return ReplayConfiguration(configuration)
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+    def detach_kernel_driver(self, interface):
+        pass
+
+    def write(self, endpoint, data, timeout=None):
+        return self._backend.replay_out(self._id, OP_WRITE, (endpoint,), bytes(data))
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        return self._backend.replay_read(self._id, endpoint, timeout)
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        if bmRequestType & usb.util.CTRL_IN:
+            request, out_data = (bmRequestType, bRequest, wValue, wIndex, data_or_wLength or 0), b''
+        else:
+            request, out_data = (bmRequestType, bRequest, wValue, wIndex, 0), bytes(data_or_wLength or b'')
+
+        return self._backend.replay_out(self._id, OP_CTRL, request, out_data)
+
+class ReplayBackend:
+    """Finds and answers devices from a recorded trace"""
+
+    def __init__(self, path, realtime=True):
+        self.realtime = realtime
+        self.devices = {}
+        self.attributes = collections.defaultdict(dict)
+        self.configurations = {}
+        # find arguments -> recorded results, and the last result replayed for them
+        self.finds = collections.defaultdict(collections.deque)
+        self.last_finds = {}
+        self.out_transfers = collections.defaultdict(collections.deque)
+        self.reads = collections.defaultdict(collections.deque)
+        self.out_counts = collections.Counter()
+        self.out_total = 0
+        self.total = 0
+        self.replayed = 0
+        self.cond = threading.Condition()
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        magic, version = FILE_HEADER.unpack_from(data)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError(f'{path} is not a trace file')
+
+        pos = FILE_HEADER.size
+        while pos < len(data):
+            op, device_id, timestamp, size = RECORD_HEADER.unpack_from(data, pos)
+            pos += RECORD_HEADER.size
+            payload = data[pos:pos + size]
+            pos += size
+            self.load_record(op, device_id, timestamp, payload)
+
+        self.start = time.monotonic()
+
+    def load_record(self, op, device_id, timestamp, payload):
+        if op == OP_DEVICE:
+            self.devices[device_id] = ReplayDevice(self, device_id, json.loads(payload))
+        elif op == OP_ATTR:
+            attribute = json.loads(payload)
+            self.attributes[device_id].setdefault(attribute['name'], attribute)
+        elif op == OP_CONFIG:
+            self.configurations.setdefault(device_id, json.loads(payload))
+        elif op == OP_FIND:
+            after, key_size = FIND.unpack_from(payload)
+            key = payload[FIND.size:FIND.size + key_size].decode()
+            ids = payload[FIND.size + key_size:]
+            self.finds[key].append((timestamp, after, struct.unpack(f'<{len(ids) // 2}H', ids)))
+        elif op == OP_WRITE:
+            endpoint, status = WRITE.unpack_from(payload)
+            self.out_transfers[device_id].append((timestamp, OP_WRITE, (endpoint,), payload[WRITE.size:], status, None))
+            self.total += 1
+        elif op == OP_CTRL:
+            *request, status, out_size = CTRL.unpack_from(payload)
+            out_data = payload[CTRL.size:CTRL.size + out_size]
+            in_data = payload[CTRL.size + out_size:]
+            self.out_transfers[device_id].append((timestamp, OP_CTRL, tuple(request), out_data, status, in_data))
+            self.total += 1
+        elif op == OP_READ:
+            endpoint, status, after = READ.unpack_from(payload)
+            self.reads[(device_id, endpoint)].append((timestamp, after, status, payload[READ.size:]))
+            self.total += 1
+
+    def wait_until(self, timestamp):
+        if self.realtime:
+            delay = self.start + timestamp - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def find(self, find_all=False, custom_match=None, **args):
+        key = findKey(find_all, custom_match, args)
+        with self.cond:
+            finds = self.finds[key]
+            ids = self.last_finds.get(key)
+            if ids == None and finds:
+                ids = finds.popleft()[2]
+
+            # skip to the latest result the replay has caught up with,
+            # in realtime also only once its time has come
+            elapsed = time.monotonic() - self.start
+            while finds and finds[0][1] <= self.out_total and (not self.realtime or finds[0][0] <= elapsed):
+                ids = finds.popleft()[2]
+
+            ids = ids or ()
+            self.last_finds[key] = ids
+
+        devices = [self.devices[i] for i in ids]
+        if find_all:
+            return iter(devices)
+        return devices[0] if devices else None
+
+    def replay_out(self, device_id, op, request, out_data):
+        with self.cond:
+            transfers = self.out_transfers[device_id]
+            if not transfers:
+                raise ReplayMismatchError(f'Device {device_id}: unexpected transfer {request}, the recording has no more')
+
+            timestamp, recorded_op, recorded_request, recorded_data, status, in_data = transfers[0]
+            if (recorded_op, recorded_request, recorded_data) != (op, request, out_data):
+                # show the data from where it starts to differ
+                pos = next((i for i, (a, b) in enumerate(zip(out_data, recorded_data)) if a != b), min(len(out_data), len(recorded_data)))
+                raise ReplayMismatchError(
+                    f'Device {device_id}: transfer {self.out_counts[device_id]} is {request} with {len(out_data)} bytes, ' +
+                    f'recorded was {recorded_request} with {len(recorded_data)} bytes, differing at offset {pos}: ' +
+                    f'{out_data[pos:pos + 16].hex()} != {recorded_data[pos:pos + 16].hex()}')
+
+            transfers.popleft()
+            self.out_counts[device_id] += 1
+            self.out_total += 1
+            self.replayed += 1
+            self.cond.notify_all()
+
+        self.wait_until(timestamp)
+        if status < 0:
+            raiseStatus(status)
+
+        if in_data != None:
+            return array.array('B', in_data)
+        return status
+
+    def replay_read(self, device_id, endpoint, timeout):
+        reads = self.reads[(device_id, endpoint)]
+        with self.cond:
+            # a report can't arrive before the transfers which caused it
+            if not self.cond.wait_for(lambda: reads and self.out_counts[device_id] >= reads[0][1], (timeout or 1000) / 1000):
+                raise usb.core.USBTimeoutError('Operation timed out', None, errno.ETIMEDOUT)
+
+            timestamp, _after, status, data = reads.popleft()
+            self.replayed += 1
+
+        self.wait_until(timestamp)
+        if status < 0:
+            raiseStatus(status)
+
+        return array.array('B', data)
+
+    def close(self):
+        print(f'Replayed {self.replayed} of {self.total} transfers')
+        remaining = sum([len(t) for t in self.out_transfers.values()])
+        if remaining:
+            print(f'{remaining} recorded transfers were not made')
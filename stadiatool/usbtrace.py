@@ -0,0 +1,59 @@
+"""
+Instrumentation of the HID layer and the protocols on top of it.
+
+A Tracer is attached to a HID instance (hid.tracer) and receives timestamped
+events for every report, command, response, queue depth change and timeout.
+Events are kept in a bounded ring buffer and can be exported as Chrome trace
+JSON (chrome://tracing, Perfetto).
+"""
+
+import collections
+import json
+import threading
+import time
+
+class Event:
+    __slots__ = ('timestamp', 'name', 'thread', 'args')
+
+    def __init__(self, timestamp, name, thread, args):
+        self.timestamp = timestamp
+        self.name = name
+        self.thread = thread
+        self.args = args
+
+class Tracer:
+    RING_SIZE = 100000
+
+    events = None
+    start = 0
+
+    def __init__(self, ring_size=RING_SIZE):
+        self.events = collections.deque(maxlen=ring_size)
+        self.start = time.perf_counter_ns()
+
+    def event(self, name, **args):
+        # deque appends are atomic, no lock needed
+        self.events.append(Event(time.perf_counter_ns(), name, threading.get_ident(), args))
+
+    def clear(self):
+        self.events.clear()
+
+    def summary(self):
+        """Returns the number of events per event name"""
+        return dict(collections.Counter([e.name for e in list(self.events)]))
+
+    def export_chrome(self, path):
+        trace_events = []
+        for e in list(self.events):
+            trace_events.append({
+                'name': e.name,
+                'ph': 'i',
+                's': 't',
+                'ts': (e.timestamp - self.start) / 1000,
+                'pid': 0,
+                'tid': e.thread,
+                'args': e.args,
+            })
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
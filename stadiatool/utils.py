@@ -1,6 +1,40 @@
+import mmap
+import contextlib
+import functools
+import os
+
 def get_file(file):
     with open(file, 'rb') as f:
         return f.read()
 
+# data files are small and read over and over again
+@functools.lru_cache(maxsize=16)
 def get_data_file(file):
     return get_file('./data/' + file)
+
+def mmap_file(file):
+    """
+    Maps a file read-only instead of reading it into memory.
+    The mapping is closed once it isn't referenced anymore, empty files can't be mapped and give b''.
+    """
+    with open(file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+@contextlib.contextmanager
+def map_file(file):
+    """Same as mmap_file, but as a context manager which closes the mapping on exit"""
+    data = mmap_file(file)
+    try:
+        yield data
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+def map_data_file(file):
+    return map_file('./data/' + file)
+
+def format_throughput(size, seconds):
+    rate = size / seconds if seconds > 0 else 0
+    return f'{size} bytes in {seconds:.2f}s ({rate / 1024:.1f} KiB/s)'